@@ -0,0 +1,70 @@
+import time
+from collections import OrderedDict
+
+class ResultCache():
+    """
+    LRU кэш с ограничением по времени жизни записи (TTL), количеству записей и суммарному размеру.
+    Ключ - хэш содержимого изображения, значение - результат обработки.
+    """
+    def __init__(self, max_entries=256, ttl=600, max_bytes=256 * 1024 * 1024, sizeof=None):
+        """
+        max_entries: максимальное количество записей
+        ttl: время жизни записи в секундах
+        max_bytes: максимальный суммарный размер записей (считается функцией sizeof)
+        sizeof: функция, возвращающая размер записи в байтах
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof if sizeof is not None else (lambda value: 0)
+        self.entries = OrderedDict() # key -> (expires_at, size, value)
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, size, value = entry
+        if expires_at < time.monotonic():
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if self.max_entries <= 0:
+            return
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = (time.monotonic() + self.ttl, size, value)
+        self.total_bytes += size
+        # Вытесняем самые давно использованные записи.
+        while len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes:
+            oldest_key = next(iter(self.entries))
+            self._remove(oldest_key)
+            self.evictions += 1
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations
+        }
+
+    def _remove(self, key):
+        expires_at, size, value = self.entries.pop(key)
+        self.total_bytes -= size
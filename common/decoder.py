@@ -1,22 +1,66 @@
 # Декодер
+import math
+import numpy as np
+import torch.nn.functional as F
 from torchnlp.encoders import LabelEncoder
-from torchaudio.models.decoder import ctc_decoder
+
+def _logaddexp(a: float, b: float) -> float:
+    if a == -math.inf:
+        return b
+    if b == -math.inf:
+        return a
+    if a > b:
+        return a + math.log1p(math.exp(b - a))
+    return b + math.log1p(math.exp(a - b))
 
 class CTCDecoder():
-    def __init__(self, characters):
+    # Способы декодирования:
+    # flashlight - beam search из flashlight (beam_size=200),
+    # greedy - жадное декодирование (best path) сразу для всего батча,
+    # prefix - prefix beam search с небольшим beam_size.
+    METHODS = ("flashlight", "greedy", "prefix")
+
+    def __init__(self, characters, method="flashlight", beam_size=8):
         """
         characters: массив символов, которые должны декодировать
+        method: способ декодирования (см. METHODS)
+        beam_size: размер beam для prefix beam search
         """
+        if method not in self.METHODS:
+            raise ValueError(f"Unknown decoding method '{method}'. Supported methods: {', '.join(self.METHODS)}.")
         self.blank_token = '-'
         self.sil_token = ' '
         self.characters = characters.copy()
+        self.method = method
+        self.beam_size = beam_size
         self.encoder = LabelEncoder(self.characters, reserved_labels=[self.blank_token], unknown_index=0)
-        self.decoder = ctc_decoder(tokens=self.encoder.index_to_token,
-                                   lexicon=None, nbest=1, beam_size=200,
-                                   blank_token=self.blank_token,
-                                   sil_token=self.sil_token)
-    
+        self.blank_index = self.encoder.token_to_index[self.blank_token]
+        self.tokens = np.array(self.encoder.index_to_token)
+        self.decoder = None
+        if self.method == "flashlight":
+            # torchaudio нужен только для flashlight, импортируем его только в этом случае.
+            from torchaudio.models.decoder import ctc_decoder
+            self.decoder = ctc_decoder(tokens=self.encoder.index_to_token,
+                                       lexicon=None, nbest=1, beam_size=200,
+                                       blank_token=self.blank_token,
+                                       sil_token=self.sil_token)
+
     def decode(self, logits): # Тут на входе logits из модели в размере T, B, N
+        if self.method == "flashlight":
+            return self._flashlight_decode(logits)
+        return [text for text, confidences in self.decode_with_confidence(logits)]
+
+    # Декодирование с confidence для каждого символа (вероятность символа по выходу модели).
+    # На выходе список (text, confidences). Для flashlight confidences не вычисляются (None).
+    def decode_with_confidence(self, logits): # T, B, N
+        if self.method == "flashlight":
+            return [(text, None) for text in self._flashlight_decode(logits)]
+        probs = F.softmax(logits.detach().float(), dim=2)
+        if self.method == "greedy":
+            return self._greedy_decode(probs)
+        return self._prefix_decode(probs)
+
+    def _flashlight_decode(self, logits):
         decoder_input = logits.permute(1, 0, 2).detach().cpu() # B, T, N
         decoder_input = decoder_input.contiguous()
         beam_search_result = self.decoder(decoder_input)
@@ -33,3 +77,88 @@ class CTCDecoder():
             text = text.replace(' ','').replace(',','.')
             result.append(text)
         return result
+
+    # Уверенность распознавания для каждого элемента батча, не зависящая от способа декодирования:
+    # среднее геометрическое вероятностей лучшего пути CTC по всем кадрам (включая blank).
+    def path_confidence(self, logits): # T, B, N
+        log_probs = F.log_softmax(logits.detach().float(), dim=2)
+        return log_probs.max(dim=2).values.mean(dim=0).exp().cpu().tolist()
+
+    # Жадное декодирование: argmax по символам для всего батча, затем схлопывание повторов и удаление blank.
+    def _greedy_decode(self, probs): # T, B, N
+        best_probs, best_indices = probs.max(dim=2)
+        best_probs = best_probs.t().cpu().numpy() # B, T
+        best_indices = best_indices.t().cpu().numpy() # B, T
+        # Начало каждой серии одинаковых символов.
+        run_starts = np.ones_like(best_indices, dtype=bool)
+        run_starts[:, 1:] = best_indices[:, 1:] != best_indices[:, :-1]
+
+        result = []
+        for indices, item_probs, item_run_starts in zip(best_indices, best_probs, run_starts):
+            starts = np.flatnonzero(item_run_starts)
+            run_indices = indices[starts]
+            # Confidence символа - максимальная вероятность в его серии.
+            run_probs = np.maximum.reduceat(item_probs, starts)
+            keep = run_indices != self.blank_index
+            result.append(self._to_text(run_indices[keep], run_probs[keep]))
+        return result
+
+    # Prefix beam search (в логарифмах вероятностей) для каждого элемента батча.
+    def _prefix_decode(self, probs): # T, B, N
+        log_probs = probs.clamp_min(1e-12).log().permute(1, 0, 2).cpu().numpy() # B, T, N
+        probs = probs.permute(1, 0, 2).cpu().numpy()
+        return [self._prefix_decode_item(item_log_probs, item_probs) for item_log_probs, item_probs in zip(log_probs, probs)]
+
+    def _prefix_decode_item(self, log_probs, probs):
+        # prefix -> [log вероятность с blank в конце, log вероятность с символом в конце]
+        beams = {(): [0.0, -math.inf]}
+        # prefix -> confidence символов префикса
+        confidences = {(): ()}
+        # Символы с маленькой вероятностью в кадре не рассматриваем.
+        min_log_prob = math.log(1e-3)
+        for t in range(log_probs.shape[0]):
+            candidates = [int(c) for c in np.flatnonzero(log_probs[t] > min_log_prob) if c != self.blank_index]
+            frame_log_probs = log_probs[t].tolist()
+            frame_probs = probs[t].tolist()
+            next_beams = {}
+            next_confidences = {}
+            for prefix, (p_blank, p_non_blank) in beams.items():
+                p_total = _logaddexp(p_blank, p_non_blank)
+                self._add_beam(next_beams, next_confidences, prefix, confidences[prefix],
+                               p_total + frame_log_probs[self.blank_index], -math.inf)
+                last = prefix[-1] if len(prefix) > 0 else None
+                for c in candidates:
+                    p = frame_log_probs[c]
+                    new_prefix = prefix + (c,)
+                    new_confidences = confidences[prefix] + (frame_probs[c],)
+                    if c == last:
+                        # Повтор символа без blank между ними схлопывается в тот же префикс.
+                        self._add_beam(next_beams, next_confidences, prefix, confidences[prefix], -math.inf, p_non_blank + p)
+                        self._add_beam(next_beams, next_confidences, new_prefix, new_confidences, -math.inf, p_blank + p)
+                    else:
+                        self._add_beam(next_beams, next_confidences, new_prefix, new_confidences, -math.inf, p_total + p)
+            best_prefixes = sorted(next_beams, key=lambda prefix: _logaddexp(*next_beams[prefix]), reverse=True)[:self.beam_size]
+            beams = {prefix: next_beams[prefix] for prefix in best_prefixes}
+            confidences = {prefix: next_confidences[prefix] for prefix in best_prefixes}
+
+        best_prefix = max(beams, key=lambda prefix: _logaddexp(*beams[prefix]))
+        return self._to_text(np.array(best_prefix, dtype=int), np.array(confidences[best_prefix], dtype=float))
+
+    def _add_beam(self, beams, confidences, prefix, prefix_confidences, p_blank, p_non_blank):
+        if prefix not in beams:
+            beams[prefix] = [p_blank, p_non_blank]
+            confidences[prefix] = prefix_confidences
+            return
+        beam = beams[prefix]
+        # Для совпадающих префиксов оставляем confidence более вероятного пути.
+        if _logaddexp(p_blank, p_non_blank) > _logaddexp(*beam):
+            confidences[prefix] = prefix_confidences
+        beam[0] = _logaddexp(beam[0], p_blank)
+        beam[1] = _logaddexp(beam[1], p_non_blank)
+
+    # Индексы символов -> текст (как у flashlight: без пробелов, ',' заменяется на '.').
+    def _to_text(self, indices, confidences):
+        chars = self.tokens[indices] if len(indices) > 0 else np.array([], dtype=str)
+        keep = chars != self.sil_token
+        text = ''.join(chars[keep]).replace(',', '.')
+        return text, [float(c) for c in confidences[keep]]
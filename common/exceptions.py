@@ -7,3 +7,27 @@ class ImageNotFoundException(Exception):
     def __init__(self, message):
         self.message = message
         super().__init__(self.message)
+
+
+class ServiceOverloadedException(Exception):
+    """
+    Exception raised when the processing queue is full.
+    Attributes:
+        message - explanation of the error
+        retry_after - estimated number of seconds after which the client can retry
+    """
+    def __init__(self, message, retry_after):
+        self.message = message
+        self.retry_after = retry_after
+        super().__init__(self.message)
+
+
+class ImageTooLargeException(Exception):
+    """
+    Exception raised when an uploaded image can't fit into the temporary storage at all.
+    Attributes:
+        message - explanation of the error
+    """
+    def __init__(self, message):
+        self.message = message
+        super().__init__(self.message)
@@ -0,0 +1,84 @@
+import io
+from PIL import Image, ImageOps
+
+class ImageSource():
+    """
+    Изображение для конвейера обработки: загруженные байты, путь к файлу или уже открытое PIL Image.
+    Для детекции JPEG декодируется в уменьшенном размере (DCT scaling), детектор все равно уменьшает изображение.
+    Области показаний вырезаются из изображения, декодированного с наименьшим разрешением,
+    при котором каждая область не меньше входа OCR модели.
+    Координаты областей - в полном разрешении изображения (после поворота по EXIF).
+    """
+    # Масштабы, с которыми может декодироваться JPEG.
+    SCALES = (8, 4, 2, 1)
+
+    def __init__(self, source, detection_size=0):
+        """
+        source: bytes, путь к файлу или PIL Image
+        detection_size: минимальный размер стороны изображения для детекции (0 - декодировать полностью)
+        """
+        self.source = source
+        self.detection_size = detection_size
+        # Изображение для детекции и его масштаб относительно полного разрешения.
+        self.image = None
+        self.scale = 1
+        # Размер в полном разрешении (W, H).
+        self.size = None
+
+    # Открывает изображение для детекции.
+    def open(self):
+        if isinstance(self.source, Image.Image):
+            self.image = self.source
+            self.size = self.source.size
+            return self
+        image = self._open_source()
+        scale = 1
+        if self.detection_size > 0:
+            scale = max(1, min(image.size) // self.detection_size)
+        self.image, self.scale = self._decode(image, scale)
+        return self
+
+    # Вырезает области boxes ([x1, y1, x2, y2] в полном разрешении).
+    # min_size - размер входа OCR модели (W, H): области не уменьшаются сильнее этого размера.
+    def crop(self, boxes: list, min_size=(384, 64)) -> list:
+        if len(boxes) == 0:
+            return []
+        image, scale = self.image, self.scale
+        # Изображение для детекции подходит, если его разрешения достаточно для всех областей.
+        crop_scale = self._crop_scale(boxes, min_size)
+        if crop_scale < scale:
+            image, scale = self._decode(self._open_source(), crop_scale)
+        crops = []
+        for x1, y1, x2, y2 in boxes:
+            crops.append(image.crop((x1 // scale, y1 // scale, x2 // scale, y2 // scale)))
+        return crops
+
+    # Наибольший масштаб, при котором длинная и короткая стороны каждой области не меньше min_size.
+    def _crop_scale(self, boxes: list, min_size) -> int:
+        max_scale = min(min(max(x2 - x1, y2 - y1) / max(min_size), min(x2 - x1, y2 - y1) / min(min_size))
+                        for x1, y1, x2, y2 in boxes)
+        return next((scale for scale in self.SCALES if scale <= max_scale), 1)
+
+    def _open_source(self):
+        source = self.source
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            source = io.BytesIO(source)
+        return Image.open(source)
+
+    # Декодирует открытое изображение с уменьшением в scale раз (только JPEG, иначе в полном размере)
+    # и поворачивает по EXIF. Возвращает изображение и фактический масштаб.
+    def _decode(self, image: Image, scale: int):
+        raw_size = image.size
+        actual_scale = 1
+        if scale > 1 and image.format in ("JPEG", "MPO"):
+            width, height = raw_size
+            draft = image.draft(image.mode, (width // scale, height // scale))
+            if draft is not None:
+                actual_scale = round(width / draft[1][2])
+        decoded_size = image.size
+        # Применяем настройки из EXIF, иначе изображение может быть повернутым после открытия.
+        image = ImageOps.exif_transpose(image)
+        if self.size is None:
+            # Размер в полном разрешении берем из заголовка (при уменьшении размер округляется вверх).
+            self.size = raw_size if image.size == decoded_size else raw_size[::-1]
+        return image, actual_scale
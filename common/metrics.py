@@ -0,0 +1,131 @@
+import math
+import threading
+
+# Границы бакетов гистограммы по умолчанию (секунды).
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+def _format_labels(labels: dict) -> str:
+    if len(labels) == 0:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for value in labels.values())
+    return "{" + ",".join(f"{name}=\"{value}\"" for name, value in zip(labels, escaped)) + "}"
+
+class Histogram():
+    """
+    Гистограмма в формате Prometheus: накопительные бакеты, сумма и количество значений
+    для каждой комбинации меток.
+    """
+    def __init__(self, name: str, description: str, buckets=DEFAULT_BUCKETS, label_names=()):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self.label_names = tuple(label_names)
+        # Значения меток -> [количество в каждом бакете, сумма, количество]
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels[name]) for name in self.label_names)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = [[0] * len(self.buckets), 0.0, 0]
+                self.series[key] = series
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][index] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def collect(self) -> list:
+        with self.lock:
+            series = {key: (list(counts), total, count) for key, (counts, total, count) in self.series.items()}
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total, count) in sorted(series.items()):
+            labels = dict(zip(self.label_names, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_format_labels({**labels, 'le': _format_value(bound)})} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+        return lines
+
+class Counter():
+    """
+    Счетчик в формате Prometheus для каждой комбинации меток.
+    """
+    def __init__(self, name: str, description: str, label_names=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        # Значения меток -> значение счетчика
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def inc(self, value=1, **labels):
+        key = tuple(str(labels[name]) for name in self.label_names)
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + value
+
+    # Текущие значения: {значения меток: значение счетчика}.
+    def values(self) -> dict:
+        with self.lock:
+            return dict(self.series)
+
+    def collect(self) -> list:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self.values().items()):
+            lines.append(f"{self.name}{_format_labels(dict(zip(self.label_names, key)))} {_format_value(value)}")
+        return lines
+
+class Gauge():
+    """
+    Текущее значение в формате Prometheus. Значение вычисляется функцией при каждом чтении метрик.
+    """
+    def __init__(self, name: str, description: str, function):
+        self.name = name
+        self.description = description
+        self.function = function
+
+    def collect(self) -> list:
+        return [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} gauge",
+                f"{self.name} {_format_value(self.function())}"]
+
+class MetricsRegistry():
+    """
+    Набор метрик сервиса для отдачи в формате Prometheus (text exposition format).
+    """
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self):
+        self.metrics = []
+
+    def histogram(self, name: str, description: str, buckets=DEFAULT_BUCKETS, label_names=()) -> Histogram:
+        histogram = Histogram(name, description, buckets, label_names)
+        self.metrics.append(histogram)
+        return histogram
+
+    def counter(self, name: str, description: str, label_names=()) -> Counter:
+        counter = Counter(name, description, label_names)
+        self.metrics.append(counter)
+        return counter
+
+    def gauge(self, name: str, description: str, function) -> Gauge:
+        gauge = Gauge(name, description, function)
+        self.metrics.append(gauge)
+        return gauge
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,59 @@
+import numpy as np
+from PIL import Image
+
+class RoiTracker():
+    """
+    Отслеживание области показаний между ключевыми кадрами видео.
+    Шаблон области берется с ключевого кадра и ищется в окрестности предыдущего положения
+    (нормированная корреляция cv2.matchTemplate) на уменьшенном сером кадре. Размер области не меняется.
+    Если совпадение хуже min_score, область считается потерянной.
+    """
+    def __init__(self, frame: Image, box: list, search_margin=0.5, min_score=0.6, max_side=640):
+        """
+        frame: ключевой кадр
+        box: область [x1, y1, x2, y2] в координатах кадра
+        search_margin: окрестность поиска в долях размера области
+        min_score: минимальная корреляция, при которой область считается найденной
+        max_side: кадр уменьшается до этого размера большей стороны
+        """
+        self.search_margin = search_margin
+        self.min_score = min_score
+        self.scale = max(1.0, max(frame.size) / max_side)
+        self.box = [float(c) for c in box]
+        self.score = 1.0
+        x1, y1, x2, y2 = self._to_small(self.box)
+        self.template = self._gray(frame)[y1:y2, x1:x2].copy()
+
+    # Ищет область на следующем кадре. Возвращает новую область или None, если область потеряна.
+    def update(self, frame: Image):
+        import cv2
+        gray = self._gray(frame)
+        template_height, template_width = self.template.shape
+        if template_height < 4 or template_width < 4:
+            return None
+        x1, y1, x2, y2 = self._to_small(self.box)
+        margin_x = int(template_width * self.search_margin) + 1
+        margin_y = int(template_height * self.search_margin) + 1
+        left, top = max(0, x1 - margin_x), max(0, y1 - margin_y)
+        region = gray[top:min(gray.shape[0], y1 + template_height + margin_y), left:min(gray.shape[1], x1 + template_width + margin_x)]
+        if region.shape[0] < template_height or region.shape[1] < template_width:
+            return None
+        scores = cv2.matchTemplate(region, self.template, cv2.TM_CCOEFF_NORMED)
+        _, self.score, _, (match_x, match_y) = cv2.minMaxLoc(scores)
+        if self.score < self.min_score:
+            return None
+        # Сдвигаем область на найденное смещение (в координатах кадра).
+        dx = (left + match_x - x1) * self.scale
+        dy = (top + match_y - y1) * self.scale
+        width, height = frame.size
+        self.box = [min(max(self.box[0] + dx, 0), width), min(max(self.box[1] + dy, 0), height),
+                    min(max(self.box[2] + dx, 0), width), min(max(self.box[3] + dy, 0), height)]
+        return self.box
+
+    def _gray(self, frame: Image) -> np.ndarray:
+        width, height = frame.size
+        size = (max(1, round(width / self.scale)), max(1, round(height / self.scale)))
+        return np.asarray(frame.convert("L").resize(size, Image.Resampling.BILINEAR))
+
+    def _to_small(self, box: list):
+        return [int(round(c / self.scale)) for c in box]
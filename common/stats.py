@@ -0,0 +1,43 @@
+import threading
+from collections import deque
+
+class RollingStats():
+    """
+    Статистика по последним значениям (скользящее окно).
+    Используется для подбора параметров сервиса: размер батча, время ожидания в очереди и т.д.
+    """
+    def __init__(self, window_size=1000):
+        self.values = deque(maxlen=window_size)
+        self.count = 0
+        self.total = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, value: float):
+        with self.lock:
+            self.values.append(value)
+            self.count += 1
+            self.total += value
+
+    def percentile(self, q: float):
+        with self.lock:
+            values = sorted(self.values)
+        if len(values) == 0:
+            return None
+        index = min(len(values) - 1, max(0, int(round(q / 100 * (len(values) - 1)))))
+        return values[index]
+
+    def summary(self):
+        with self.lock:
+            values = list(self.values)
+            count = self.count
+            total = self.total
+        if len(values) == 0:
+            return {"count": count, "mean": None, "p50": None, "p95": None, "p99": None, "max": None}
+        return {
+            "count": count,
+            "mean": total / count,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+            "max": max(values)
+        }
@@ -0,0 +1,79 @@
+from collections import OrderedDict
+
+class StorageQuota():
+    """
+    Учет загруженных изображений (во временной папке или в памяти) с ограничением по количеству и суммарному размеру.
+    При превышении ограничения вытесняются самые давно использованные изображения (LRU).
+    Закрепленные изображения (еще не обработанные) не вытесняются.
+    """
+    def __init__(self, max_entries=10000, max_bytes=1024 * 1024 * 1024):
+        """
+        max_entries: максимальное количество изображений (0 - без ограничения)
+        max_bytes: максимальный суммарный размер изображений в байтах (0 - без ограничения)
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict() # key -> size
+        self.pinned = set()
+        self.total_bytes = 0
+        self.evictions = 0
+        self.rejections = 0
+
+    # Помещается ли изображение размером size в ограничение по размеру, даже если вытеснить все остальные.
+    def fits(self, size: int) -> bool:
+        return self.max_bytes <= 0 or size <= self.max_bytes
+
+    # Добавляет изображение размером size. Возвращает ключи вытесненных изображений
+    # или None, если места не хватает даже после вытеснения всех незакрепленных изображений (ничего не вытесняется).
+    def add(self, key, size: int, pinned=True):
+        if key in self.entries:
+            self.remove(key)
+        evicted = []
+        entries = len(self.entries) + 1
+        total_bytes = self.total_bytes + size
+        for candidate, candidate_size in self.entries.items():
+            if not self._exceeded(entries, total_bytes):
+                break
+            if candidate in self.pinned:
+                continue
+            evicted.append(candidate)
+            entries -= 1
+            total_bytes -= candidate_size
+        if self._exceeded(entries, total_bytes):
+            self.rejections += 1
+            return None
+        for candidate in evicted:
+            self.remove(candidate)
+        self.evictions += len(evicted)
+        self.entries[key] = size
+        self.total_bytes += size
+        if pinned:
+            self.pinned.add(key)
+        return evicted
+
+    # Отмечает использование изображения.
+    def touch(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+
+    # Снимает закрепление: изображение можно вытеснить.
+    def unpin(self, key):
+        self.pinned.discard(key)
+
+    def remove(self, key):
+        size = self.entries.pop(key, None)
+        if size is not None:
+            self.total_bytes -= size
+        self.pinned.discard(key)
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "bytes": self.total_bytes,
+            "pinned": len(self.pinned),
+            "evictions": self.evictions,
+            "rejections": self.rejections
+        }
+
+    def _exceeded(self, entries: int, total_bytes: int) -> bool:
+        return (self.max_entries > 0 and entries > self.max_entries) or (self.max_bytes > 0 and total_bytes > self.max_bytes)
@@ -5,33 +5,142 @@ import logging
 
 from contextlib import asynccontextmanager
 
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse, Response
 from fastapi.staticfiles import StaticFiles
-from fastapi import FastAPI, UploadFile, HTTPException
-from common.exceptions import ImageNotFoundException
+import zipfile
+from typing import List
+from fastapi import FastAPI, UploadFile, File, HTTPException
+from common.exceptions import ImageNotFoundException, ServiceOverloadedException, ImageTooLargeException
 
+from common.metrics import MetricsRegistry
 from services.detector_service import DetectorService
 
 DETECTOR_MODEL_PATH = './models/emeter_yolo11n_v1.pt'
 OCR_MODEL_PATH = './models/emeter_ocr_v1.pt'
 
-# Глобальный экземпляр сервиса
+# Глобальный экземпляр сервиса и задача его инициализации (загрузка и прогрев моделей).
 detector_service = None
+startup_task = None
 logger = logging.getLogger(__name__)
 
 BINDING_PORT = int(os.getenv("PORT", "8080"))
+# Параметры батчинга детектора: максимальный размер батча и максимальное ожидание (мс).
+DETECTOR_BATCH_SIZE = int(os.getenv("DETECTOR_BATCH_SIZE", "8"))
+DETECTOR_BATCH_WAIT_MS = int(os.getenv("DETECTOR_BATCH_WAIT_MS", "10"))
+# Максимальное количество изображений показаний в одном проходе OCR модели.
+OCR_BATCH_SIZE = int(os.getenv("OCR_BATCH_SIZE", "32"))
+# Количество потоков инференса, потоков torch (0 - по умолчанию) и максимальный размер очереди.
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", "1"))
+TORCH_THREADS = int(os.getenv("TORCH_THREADS", "0"))
+MAX_QUEUE_SIZE = int(os.getenv("MAX_QUEUE_SIZE", "64"))
+# Максимальное время ожидания результата (сек) в синхронном роуте /detect.
+DETECT_TIMEOUT = float(os.getenv("DETECT_TIMEOUT", "60"))
+# Кэш результатов для повторно загруженных изображений: количество записей, время жизни (сек) и размер (МБ).
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "256"))
+RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", "600"))
+RESULT_CACHE_MAX_MB = int(os.getenv("RESULT_CACHE_MAX_MB", "256"))
+# Хранить загруженные изображения в памяти (1) или во временной папке (0).
+IN_MEMORY_MODE = os.getenv("IN_MEMORY_MODE", "1") == "1"
+# Качество JPEG для изображения с результатом детекции.
+RESULT_IMAGE_QUALITY = int(os.getenv("RESULT_IMAGE_QUALITY", "85"))
+# Инференс в потоках ("thread") или в пуле процессов ("process"): количество процессов,
+# потоков torch в каждом процессе и перезапуск пула при падении процесса.
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "thread")
+INFERENCE_PROCESSES = int(os.getenv("INFERENCE_PROCESSES", "2"))
+PROCESS_TORCH_THREADS = int(os.getenv("PROCESS_TORCH_THREADS", "1"))
+PROCESS_RESTART_ON_CRASH = os.getenv("PROCESS_RESTART_ON_CRASH", "1") == "1"
+# Способ выполнения моделей: eager, torchscript, compile или onnx (см. models/backends.py),
+# и динамическая int8 квантизация OCR модели.
+DETECTOR_BACKEND = os.getenv("DETECTOR_BACKEND", "eager")
+RECOGNIZER_BACKEND = os.getenv("RECOGNIZER_BACKEND", "eager")
+RECOGNIZER_QUANTIZE = os.getenv("RECOGNIZER_QUANTIZE", "0") == "1"
+# Способ декодирования CTC: flashlight, greedy или prefix, и размер beam для prefix.
+OCR_DECODER = os.getenv("OCR_DECODER", "flashlight")
+OCR_BEAM_SIZE = int(os.getenv("OCR_BEAM_SIZE", "8"))
+# Минимальный размер стороны JPEG при декодировании для детекции (0 - декодировать в полном разрешении).
+DETECTION_DECODE_SIZE = int(os.getenv("DETECTION_DECODE_SIZE", "640"))
+# Каскад ориентации: детекция на поворотах 90/180/270°, если область показаний не найдена,
+# и сравнение распознавания каждой области с ее поворотом на 180°.
+ROTATED_DETECTION = os.getenv("ROTATED_DETECTION", "1") == "1"
+OCR_FLIP_CHECK = os.getenv("OCR_FLIP_CHECK", "1") == "1"
+# Хранилище заданий на обработку: memory (в процессе) или sqlite (общее для нескольких процессов сервиса),
+# путь к базе SQLite и период проверки хранилища на задания других процессов (сек).
+JOB_STORE = os.getenv("JOB_STORE", "memory")
+JOB_STORE_PATH = os.getenv("JOB_STORE_PATH", "jobs.sqlite3")
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "0.05"))
+# Ограничение на загруженные изображения (во временной папке или в памяти): количество и суммарный размер (МБ).
+TEMP_STORAGE_MAX_FILES = int(os.getenv("TEMP_STORAGE_MAX_FILES", "10000"))
+TEMP_STORAGE_MAX_MB = int(os.getenv("TEMP_STORAGE_MAX_MB", "1024"))
+# Количество проходов прогрева моделей при старте (0 - без прогрева).
+WARMUP_ROUNDS = int(os.getenv("WARMUP_ROUNDS", "1"))
+# Обработка видео: интервал между запусками детектора (кадров), шаг по кадрам видео, максимальное количество кадров,
+# минимальное количество кадров и доля веса, при которых показание считается устойчивым.
+VIDEO_KEYFRAME_INTERVAL = int(os.getenv("VIDEO_KEYFRAME_INTERVAL", "10"))
+VIDEO_FRAME_STEP = int(os.getenv("VIDEO_FRAME_STEP", "1"))
+VIDEO_MAX_FRAMES = int(os.getenv("VIDEO_MAX_FRAMES", "300"))
+VIDEO_MIN_VOTES = int(os.getenv("VIDEO_MIN_VOTES", "5"))
+VIDEO_STABLE_SHARE = float(os.getenv("VIDEO_STABLE_SHARE", "0.7"))
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global detector_service
+    global detector_service, startup_task
     try:
-        detector_service = await DetectorService(DETECTOR_MODEL_PATH, OCR_MODEL_PATH).initialize()
+        detector_service = DetectorService(DETECTOR_MODEL_PATH, OCR_MODEL_PATH,
+                                                 batch_size=DETECTOR_BATCH_SIZE,
+                                                 batch_wait_ms=DETECTOR_BATCH_WAIT_MS,
+                                                 ocr_batch_size=OCR_BATCH_SIZE,
+                                                 inference_workers=INFERENCE_WORKERS,
+                                                 torch_threads=TORCH_THREADS,
+                                                 max_queue_size=MAX_QUEUE_SIZE,
+                                                 result_cache_size=RESULT_CACHE_SIZE,
+                                                 result_cache_ttl=RESULT_CACHE_TTL,
+                                                 result_cache_max_bytes=RESULT_CACHE_MAX_MB * 1024 * 1024,
+                                                 in_memory=IN_MEMORY_MODE,
+                                                 result_image_quality=RESULT_IMAGE_QUALITY,
+                                                 inference_backend=INFERENCE_BACKEND,
+                                                 inference_processes=INFERENCE_PROCESSES,
+                                                 process_torch_threads=PROCESS_TORCH_THREADS,
+                                                 process_restart_on_crash=PROCESS_RESTART_ON_CRASH,
+                                                 detector_backend=DETECTOR_BACKEND,
+                                                 recognizer_backend=RECOGNIZER_BACKEND,
+                                                 recognizer_quantize=RECOGNIZER_QUANTIZE,
+                                                 ocr_decoder=OCR_DECODER,
+                                                 ocr_beam_size=OCR_BEAM_SIZE,
+                                                 detection_decode_size=DETECTION_DECODE_SIZE,
+                                                 rotated_detection=ROTATED_DETECTION,
+                                                 ocr_flip_check=OCR_FLIP_CHECK,
+                                                 job_store=JOB_STORE,
+                                                 job_store_path=JOB_STORE_PATH,
+                                                 job_poll_interval=JOB_POLL_INTERVAL,
+                                                 temp_storage_max_files=TEMP_STORAGE_MAX_FILES,
+                                                 temp_storage_max_bytes=TEMP_STORAGE_MAX_MB * 1024 * 1024,
+                                                 warmup_rounds=WARMUP_ROUNDS,
+                                                 video_keyframe_interval=VIDEO_KEYFRAME_INTERVAL,
+                                                 video_frame_step=VIDEO_FRAME_STEP,
+                                                 video_max_frames=VIDEO_MAX_FRAMES,
+                                                 video_min_votes=VIDEO_MIN_VOTES,
+                                                 video_stable_share=VIDEO_STABLE_SHARE)
+        # Модели загружаются в фоне: сервис сразу отвечает на /health/live, а на /health/ready - после загрузки и прогрева.
+        startup_task = asyncio.create_task(detector_service.initialize())
+        startup_task.add_done_callback(_log_startup_error)
         yield
     finally:
-        await detector_service.cleanup()
+        if startup_task is not None and not startup_task.done():
+            startup_task.cancel()
+        startup_task = None
+        if detector_service:
+            await detector_service.cleanup()
         detector_service = None
         print("Resources released.")
 
+def _log_startup_error(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Service initialization failed.", exc_info=task.exception())
+
+# Инициализация сервиса завершилась ошибкой.
+def _startup_failed():
+    return startup_task is not None and startup_task.done() and (startup_task.cancelled() or startup_task.exception() is not None)
+
 app = FastAPI(lifespan=lifespan)
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
@@ -42,7 +151,82 @@ async def serve_index():
 # Роут для загрузки изображения.
 @app.post("/upload/")
 async def upload_image(file: UploadFile):
-    return await detector_service.handle_upload(file)
+    try:
+        return await detector_service.handle_upload(file)
+    except ServiceOverloadedException as ex:
+        raise HTTPException(status_code=503, detail=ex.message, headers={"Retry-After": str(ex.retry_after)})
+    except ImageTooLargeException as ex:
+        raise HTTPException(status_code=413, detail=ex.message)
+
+# Роут для синхронной детекции: загружает изображение и возвращает результат одним запросом.
+@app.post("/detect/")
+async def detect_image(file: UploadFile, include_image: bool = False):
+    try:
+        result = await detector_service.detect(file, include_image=include_image, timeout=DETECT_TIMEOUT)
+    except ServiceOverloadedException as ex:
+        raise HTTPException(status_code=503, detail=ex.message, headers={"Retry-After": str(ex.retry_after)})
+    except ImageTooLargeException as ex:
+        raise HTTPException(status_code=413, detail=ex.message)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail='Image processing timed out.')
+    except Exception as ex:
+        logger.error(f"Error while detect image. {ex}", exc_info=True)
+        raise HTTPException(status_code=500, detail='Some error occurred.')
+    if result["status"] == "failed":
+        # Изображение не удалось обработать (например, файл не является изображением) - ошибка клиента.
+        raise HTTPException(status_code=422, detail=result.get("error") or 'Image processing failed.')
+    if result["status"] != "processed":
+        raise HTTPException(status_code=500, detail='Image processing failed.')
+    return JSONResponse(content=result, status_code=200)
+
+# Роут для пакетной загрузки: несколько изображений и/или zip архивов с изображениями.
+# Результаты изображений возвращаются потоком NDJSON по мере обработки, прогресс задания - GET /jobs/{job_id}.
+@app.post("/bulk/")
+async def bulk_upload(files: List[UploadFile] = File(...)):
+    try:
+        job_id, lines = await detector_service.handle_bulk(files)
+    except zipfile.BadZipFile as ex:
+        raise HTTPException(status_code=400, detail=f'Invalid zip archive. {ex}')
+    except ServiceOverloadedException as ex:
+        raise HTTPException(status_code=503, detail=ex.message, headers={"Retry-After": str(ex.retry_after)})
+    except Exception as ex:
+        logger.error(f"Error while bulk upload. {ex}", exc_info=True)
+        raise HTTPException(status_code=500, detail='Some error occurred.')
+    return StreamingResponse(lines, media_type="application/x-ndjson", headers={"X-Job-Id": job_id})
+
+# Роут для распознавания показаний по видео или последовательности кадров (изображения и/или zip архивы).
+@app.post("/video/")
+async def process_video(files: List[UploadFile] = File(...)):
+    try:
+        return await detector_service.handle_video(files)
+    except ServiceOverloadedException as ex:
+        raise HTTPException(status_code=503, detail=ex.message, headers={"Retry-After": str(ex.retry_after)})
+    except (zipfile.BadZipFile, ValueError) as ex:
+        raise HTTPException(status_code=400, detail=f'Invalid video or frames. {ex}')
+    except Exception as ex:
+        logger.error(f"Error while process video. {ex}", exc_info=True)
+        raise HTTPException(status_code=500, detail='Some error occurred.')
+
+# Роут для получения прогресса задания пакетной загрузки.
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    try:
+        return detector_service.get_job(job_id)
+    except ImageNotFoundException as ex:
+        raise HTTPException(status_code=404, detail=ex.message)
+
+# Роут для получения статуса изображения через server-sent events (без опроса /status).
+@app.get("/events/{image_uuid}")
+async def stream_status(image_uuid: str):
+    try:
+        events = await detector_service.stream_status(image_uuid)
+        return StreamingResponse(events, media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+    except Exception as ex:
+        logger.error(f"Error while get image status. {ex}", exc_info=True)
+        if isinstance(ex, ImageNotFoundException):
+            raise HTTPException(status_code=404, detail=ex.message)
+        else:
+            raise HTTPException(status_code=500, detail='Some error occurred.')
 
 # Роут для проверки статуса изображения.
 @app.get("/status/{image_uuid}")
@@ -60,8 +244,8 @@ async def check_status(image_uuid: str):
 @app.get("/result/{image_uuid}")
 async def get_result(image_uuid: str):
     try:
-        file_path = await detector_service.get_result(image_uuid)
-        return FileResponse(file_path)
+        result_image = await detector_service.get_result(image_uuid)
+        return Response(content=result_image, media_type="image/jpeg")
     except Exception as ex:
         logger.error(f"Error while get image result. {ex}", exc_info=True)
         if isinstance(ex, ImageNotFoundException):
@@ -70,15 +254,41 @@ async def get_result(image_uuid: str):
             raise HTTPException(status_code=500, detail='Some error occurred.')
 
 # Роут для получения распознанных значений счетчика.
+# С trace=true дополнительно возвращается время этапов обработки изображения (мс).
 @app.get("/values/{image_uuid}")
-async def get_values(image_uuid: str):
+async def get_values(image_uuid: str, trace: bool = False):
     try:
         values = await detector_service.get_values(image_uuid)
         content = {"values": values}
+        if trace:
+            content["trace"] = await detector_service.get_trace(image_uuid)
         return JSONResponse(content=content, status_code=200)
     except Exception as ex:
         logger.error(f"Error while get indicator values. {ex}", exc_info=True)
         raise HTTPException(status_code=500, detail='Some error occurred.')
 
+# Роут для получения статистики сервиса (размер батчей, время ожидания в очереди).
+@app.get("/stats/")
+async def get_stats():
+    return await detector_service.get_stats()
+
+# Роут для проверки, что процесс сервиса работает (liveness). Ошибка, только если инициализация сервиса не удалась.
+@app.get("/health/live")
+async def health_live():
+    if _startup_failed():
+        return JSONResponse(content={"status": "failed"}, status_code=503)
+    return {"status": "alive"}
+
+# Роут для проверки готовности сервиса принимать изображения (readiness): модели загружены и прогреты.
+@app.get("/health/ready")
+async def health_ready():
+    readiness = detector_service.get_readiness()
+    return JSONResponse(content=readiness, status_code=200 if detector_service.ready else 503)
+
+# Роут для получения метрик в формате Prometheus.
+@app.get("/metrics")
+async def get_metrics():
+    return Response(content=await detector_service.render_metrics(), media_type=MetricsRegistry.CONTENT_TYPE)
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=BINDING_PORT, log_level="info", log_config="log_config.yaml")
@@ -0,0 +1,86 @@
+import os
+import torch
+import logging
+import torch.nn as nn
+
+# Поддерживаемые способы выполнения моделей:
+# eager - обычная модель PyTorch,
+# torchscript - модель, экспортированная в TorchScript (tools/export_models.py),
+# compile - модель PyTorch, скомпилированная torch.compile при загрузке (для OCR модели),
+# onnx - модель, экспортированная в ONNX и выполняемая в ONNX Runtime (tools/export_models.py).
+BACKENDS = ("eager", "torchscript", "compile", "onnx")
+
+# Расширения файлов экспортированных моделей.
+ARTIFACT_EXTENSIONS = {
+    "torchscript": ".torchscript",
+    "onnx": ".onnx"
+}
+
+logger = logging.getLogger(__name__)
+
+def check_backend(backend: str):
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend '{backend}'. Supported backends: {', '.join(BACKENDS)}.")
+
+# Путь к экспортированной модели: рядом с исходной, с расширением бэкенда.
+# Для квантизированной модели к имени добавляется _int8.
+def artifact_path(model_path: str, backend: str, quantized=False) -> str:
+    check_backend(backend)
+    if backend not in ARTIFACT_EXTENSIONS:
+        return model_path
+    model_name, _ = os.path.splitext(model_path)
+    suffix = "_int8" if quantized else ""
+    return f"{model_name}{suffix}{ARTIFACT_EXTENSIONS[backend]}"
+
+# Динамическая int8 квантизация слоев LSTM и Linear (только CPU).
+def quantize_dynamic(model: nn.Module) -> nn.Module:
+    return torch.ao.quantization.quantize_dynamic(model, {nn.LSTM, nn.Linear}, dtype=torch.qint8)
+
+class OnnxModel():
+    """
+    Выполнение ONNX модели в ONNX Runtime. Вызывается так же, как модель PyTorch:
+    на входе тензор, на выходе кортеж тензоров.
+    """
+    def __init__(self, model_path: str, device: str):
+        try:
+            import onnxruntime
+        except ImportError as ex:
+            raise ImportError("The 'onnx' backend requires the onnxruntime package.") from ex
+        providers = ["CPUExecutionProvider"]
+        if device == "cuda":
+            providers.insert(0, "CUDAExecutionProvider")
+        self.session = onnxruntime.InferenceSession(model_path, providers=providers)
+        self.input_name = self.session.get_inputs()[0].name
+        self.device = device
+
+    def __call__(self, x: torch.Tensor):
+        outputs = self.session.run(None, {self.input_name: x.detach().cpu().numpy()})
+        return tuple(torch.from_numpy(output).to(self.device) for output in outputs)
+
+    def eval(self):
+        return self
+
+# Загрузка OCR модели для выбранного бэкенда. eager_model - модель PyTorch с загруженными весами.
+def load_recognizer_backend(eager_model: nn.Module, model_path: str, backend: str, device: str, quantize=False):
+    check_backend(backend)
+    if quantize and device != "cpu":
+        logger.warning("Dynamic int8 quantization is supported only on CPU, quantization is disabled.")
+        quantize = False
+
+    if backend == "eager":
+        return quantize_dynamic(eager_model) if quantize else eager_model
+    if backend == "compile":
+        model = quantize_dynamic(eager_model) if quantize else eager_model
+        return torch.compile(model)
+    if backend == "torchscript":
+        model = torch.jit.load(artifact_path(model_path, backend, quantize), map_location=torch.device(device))
+        model.eval()
+        return model
+    return OnnxModel(artifact_path(model_path, backend, quantize), device)
+
+# Путь к модели детектора для выбранного бэкенда. Ultralytics сама загружает TorchScript и ONNX модели.
+def detector_model_path(model_path: str, backend: str) -> str:
+    check_backend(backend)
+    if backend == "compile":
+        logger.warning("The 'compile' backend is not supported for the detector, the 'eager' backend will be used.")
+    return artifact_path(model_path, backend)
@@ -2,22 +2,33 @@ import uuid
 import torch
 import asyncio
 import logging
+import numpy as np
 
 from PIL import Image
-from ultralytics import YOLO
+from models.backends import detector_model_path
 
 class ElectricMeterDetector():
-    def __init__(self, model_path='emeter_yolo11n_v1.pt'):
+    def __init__(self, model_path='emeter_yolo11n_v1.pt', backend="eager"):
         self.conf_threshold = 0.59
-        self.model_path = model_path
+        # Способ выполнения модели (см. models/backends.py): eager, torchscript или onnx.
+        self.backend = backend
+        self.model_path = detector_model_path(model_path, backend)
         self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
         self.logger = logging.getLogger(__name__)
         self.indicator_class_index = 1.0
 
     async def load_model(self):
-        self.model = YOLO(self.model_path)
-        self.model.to(self.device)
-        self.logger.info(f"Detector loaded. The '{self.device}' device will be used.")
+        return self.load()
+
+    # Синхронная загрузка модели (для потоков и процессов инференса, без event loop).
+    def load(self):
+        # ultralytics импортируется при загрузке модели, а не при импорте модуля: это заметно ускоряет старт сервиса
+        # и не нужно основному процессу при инференсе в пуле процессов.
+        from ultralytics import YOLO
+        self.model = YOLO(self.model_path, task="detect")
+        if self.backend in ("eager", "compile"):
+            self.model.to(self.device)
+        self.logger.info(f"Detector loaded. The '{self.device}' device and the '{self.backend}' backend will be used.")
         return self
 
     # Освобождение ресурсов.
@@ -29,3 +40,27 @@ class ElectricMeterDetector():
     def process_image(self, image_uuid: str, image: Image):
         detector_results = self.model.predict(source=image, conf=self.conf_threshold, save=False, device=self.device)
         return detector_results[0]
+
+    # Функция детекции сразу на нескольких изображениях (один вызов predict на весь батч).
+    def process_images(self, images: list):
+        if len(images) == 0:
+            return []
+        detector_results = self.model.predict(source=images, conf=self.conf_threshold, save=False, device=self.device)
+        return list(detector_results)
+
+    # Прогрев модели: детекция на батче пустых изображений. Первый вызов predict инициализирует предиктор,
+    # импортирует оставшиеся модули ultralytics/torchvision и выделяет память, без прогрева это ждет первый запрос.
+    def warmup(self, batch_size=1, image_size=640):
+        self.process_images([Image.new("RGB", (image_size, image_size))] * max(1, batch_size))
+
+
+    # Рисует найденные области на изображении (так же, как Results.plot после детекции).
+    # detections - список {"class_index": int, "confidence": float, "box": [x1, y1, x2, y2]}.
+    def render(self, image: Image, detections: list) -> Image:
+        from ultralytics.engine.results import Results
+        orig_img = np.asarray(image.convert("RGB"))[..., ::-1] # RGB -> BGR
+        boxes = torch.tensor([[*d["box"], d["confidence"], d["class_index"]] for d in detections], dtype=torch.float32).reshape(-1, 6)
+        # Названия классов берем из самих областей, чтобы рисовать без загруженной модели (например, при инференсе в других процессах).
+        names = {d["class_index"]: d["class"] for d in detections}
+        result = Results(np.ascontiguousarray(orig_img), path="", names=names, boxes=boxes)
+        return Image.fromarray(result.plot()[..., ::-1])
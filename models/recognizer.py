@@ -1,39 +1,72 @@
-import cv2
+import time
 import torch
 import asyncio
 import logging
+import threading
+import numpy as np
+from PIL import Image
+from typing import Any, Dict
 
 from models.crnn import CRNN
-from torchvision.transforms import v2
+from models.backends import check_backend, load_recognizer_backend
 from common.decoder import CTCDecoder
 
+# cv2 импортируется при первой подготовке изображений (не нужен при импорте модуля).
+_cv2 = None
+
+def _get_cv2():
+    global _cv2
+    if _cv2 is None:
+        import cv2
+        _cv2 = cv2
+    return _cv2
+
 class NumbersRecognizer():
-    def __init__(self, model_path):
+    def __init__(self, model_path, max_batch_size=32, backend="eager", quantize=False, decoder="flashlight", beam_size=8):
         self.num_of_channels = 3
         self.hidden_size = 256
         self.characters = list(" 0123456789.,")
         self.num_of_chars = len(self.characters) + 1
         self.model_path = model_path
+        # Максимальное количество изображений в одном проходе модели.
+        self.max_batch_size = max(1, max_batch_size)
+        # Способ выполнения модели (см. models/backends.py) и динамическая int8 квантизация.
+        check_backend(backend)
+        self.backend = backend
+        self.quantize = quantize
         self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
         self.logger = logging.getLogger(__name__)
-        self.ctc_decoder = CTCDecoder(self.characters)
-        self.transform_image = v2.Compose([
-            v2.Lambda(self._conditional_rotate),
-            v2.Resize((64, 384)), # H, W
-            v2.ToImage(),
-            v2.ToDtype(torch.float32, scale=True),
-            v2.Lambda(self._clahe_transform)
-        ])
+        # Способ декодирования CTC: flashlight, greedy или prefix (см. CTCDecoder).
+        self.ctc_decoder = CTCDecoder(self.characters, method=decoder, beam_size=beam_size)
+        # Размер входа модели: H, W.
+        self.input_size = (64, 384)
+        # CLAHE создается один раз для каждого потока инференса (объект cv2 хранит внутренние буферы).
+        self.thread_local = threading.local()
 
     async def load_model(self):
-        self.model = CRNN(self.num_of_channels, self.num_of_chars, self.hidden_size)
-        self.model.to(self.device)
-        model_state_dict = torch.load(self.model_path, map_location=torch.device(self.device))
-        self.model.load_state_dict(model_state_dict)
-        self.model.eval()
-        self.logger.info(f"Recognizer loaded. The '{self.device}' device will be used.")
+        return self.load()
+
+    # Синхронная загрузка модели (для потоков и процессов инференса, без event loop).
+    def load(self):
+        eager_model = self.build_eager_model() if self.backend in ("eager", "compile") else None
+        self.model = load_recognizer_backend(eager_model, self.model_path, self.backend, self.device, self.quantize)
+        self.logger.info(f"Recognizer loaded. The '{self.device}' device and the '{self.backend}' backend will be used.")
         return self
 
+    # Модель PyTorch с загруженными весами.
+    def build_eager_model(self):
+        model = CRNN(self.num_of_channels, self.num_of_chars, self.hidden_size)
+        model.to(self.device)
+        model_state_dict = torch.load(self.model_path, map_location=torch.device(self.device))
+        model.load_state_dict(model_state_dict)
+        model.eval()
+        return model
+
+    # Прогрев модели: распознавание батча пустых изображений показаний.
+    def warmup(self, batch_size=1):
+        height, width = self.input_size
+        self.recognize_batch({0: [Image.new("RGB", (width, height))] * max(1, batch_size)})
+
     # Освобождение ресурсов.
     def release_resource(self):
         if torch.cuda.is_available():
@@ -41,35 +74,113 @@ class NumbersRecognizer():
 
     # Функция распознавания показания счетчика из результата работы детектора
     def parse_indicator_values(self, indicator_images: []) -> []:
+        return self.recognize_batch({0: indicator_images})[0]
+
+    # Пакетное распознавание показаний для нескольких источников (например, нескольких изображений).
+    # На входе словарь {ключ источника: [изображения показаний]},
+    # на выходе {ключ источника: [значения]} в том же порядке, что и изображения.
+    # С with_confidence=True каждое значение - кортеж (значение, confidence символов).
+    # В timings (если передан) добавляется время этапов: ocr_preprocess, ocr_forward, ctc_decode (сек).
+    # С check_flipped=True каждое изображение распознается еще и повернутым на 180° в том же проходе модели,
+    # берется вариант с большей уверенностью CTC (см. CTCDecoder.path_confidence).
+    # В flipped (если передан) для каждого ключа источника записывается количество значений с повернутых изображений.
+    def recognize_batch(self, indicator_images: Dict[Any, list], with_confidence=False, timings: dict = None,
+                        check_flipped=False, flipped: dict = None) -> Dict[Any, list]:
+        keys = []
+        images = []
+        for key, key_images in indicator_images.items():
+            for img in key_images:
+                keys.append(key)
+                images.append(img)
+
+        timings = timings if timings is not None else {}
+        if check_flipped:
+            recognized = self._recognize_flipped(images, timings)
+        else:
+            recognized = [(value, confidences, False) for value, confidences in self._recognize(images, timings)]
+        result = {key: [] for key in indicator_images}
+        if flipped is not None:
+            flipped.update({key: 0 for key in indicator_images})
+        for key, (value, confidences, is_flipped) in zip(keys, recognized):
+            result[key].append((value, confidences) if with_confidence else value)
+            if flipped is not None and is_flipped:
+                flipped[key] += 1
+        return result
+
+    # Распознавание изображений и их поворотов на 180° (пары идут подряд и попадают в один батч модели).
+    # Вариант выбирается по уверенности CTC до декодирования, декодируется только он
+    # (beam search flashlight не выполняется для обоих вариантов).
+    # На выходе (значение, confidence символов, взято ли значение с повернутого изображения).
+    def _recognize_flipped(self, images: list, timings: dict) -> list:
+        pairs = []
+        for img in images:
+            pairs.append(img)
+            pairs.append(img.transpose(Image.Transpose.ROTATE_180))
         result = []
+        # Размер батча четный, чтобы изображение и его поворот распознавались в одном проходе.
+        batch_size = max(2, self.max_batch_size - self.max_batch_size % 2)
         with torch.no_grad():
-            for img in indicator_images:
-                image_tensor = self.transform_image(img).unsqueeze(0).to(self.device)
-                ocr_output, encoder_out_lens = self.model(image_tensor)
-                indicator_value = self.ctc_decoder.decode(ocr_output)
-                result.append(indicator_value)
+            for ocr_output in self._forward(pairs, timings, batch_size):
+                started_at = time.perf_counter()
+                scores = self.ctc_decoder.path_confidence(ocr_output)
+                is_flipped = [rotated > upright for upright, rotated in zip(scores[0::2], scores[1::2])]
+                selected = [index * 2 + int(rotated) for index, rotated in enumerate(is_flipped)]
+                decoded = self.ctc_decoder.decode_with_confidence(ocr_output[:, selected])
+                result.extend(([text], confidences, rotated) for (text, confidences), rotated in zip(decoded, is_flipped))
+                timings["ctc_decode"] += time.perf_counter() - started_at
         return result
 
-    def _conditional_rotate(self, img):
-        if img.height > img.width:
-            return v2.functional.rotate(img, angle=90, expand=True)  # Поворот на 90°
-        return img
-
-    def _apply_clahe(self, image):
-        if len(image.shape) == 3:
-            image = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
-        clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-        clahe_image = clahe.apply(image)
-
-        if len(clahe_image.shape) == 2:
-            clahe_image = cv2.cvtColor(clahe_image, cv2.COLOR_GRAY2RGB)
-        return clahe_image
-    
-    def _clahe_transform(self, image):
-        if isinstance(image, torch.Tensor):
-            image = image.permute(1, 2, 0).numpy() * 255
-            image = image.astype('uint8')
-
-        clahe_image = self._apply_clahe(image)
-        clahe_image = torch.from_numpy(clahe_image).permute(2, 0, 1).float() / 255.0
-        return clahe_image
\ No newline at end of file
+    # Распознавание списка изображений батчами не больше max_batch_size.
+    # На выходе (значение, confidence символов) для каждого изображения.
+    def _recognize(self, images: list, timings: dict) -> list:
+        result = []
+        with torch.no_grad():
+            for ocr_output in self._forward(images, timings, self.max_batch_size):
+                started_at = time.perf_counter()
+                # Значение для каждого изображения - список из одной строки (как при декодировании батча из одного элемента).
+                decoded = self.ctc_decoder.decode_with_confidence(ocr_output)
+                result.extend(([text], confidences) for text, confidences in decoded)
+                timings["ctc_decode"] += time.perf_counter() - started_at
+        return result
+
+    # Подготовка и проход модели батчами по batch_size изображений. Возвращает выход модели (T, B, N) для каждого батча.
+    # Время подготовки и прохода модели добавляется в timings, время декодирования добавляет вызывающий код.
+    def _forward(self, images: list, timings: dict, batch_size: int):
+        for stage in ("ocr_preprocess", "ocr_forward", "ctc_decode"):
+            timings.setdefault(stage, 0.0)
+        for start in range(0, len(images), batch_size):
+            started_at = time.perf_counter()
+            image_tensor = self.preprocess(images[start:start + batch_size]).to(self.device)
+            preprocessed_at = time.perf_counter()
+            ocr_output, encoder_out_lens = self.model(image_tensor)
+            timings["ocr_preprocess"] += preprocessed_at - started_at
+            timings["ocr_forward"] += time.perf_counter() - preprocessed_at
+            yield ocr_output
+
+    # Подготовка батча изображений показаний за один проход по uint8 массивам:
+    # поворот вертикальных изображений, resize, CLAHE по яркости и запись сразу в тензор батча (B, 3, H, W).
+    # Результат совпадает с прежней цепочкой transforms (rotate, Resize, ToDtype, CLAHE по RGB->GRAY->RGB).
+    def preprocess(self, images: list) -> torch.Tensor:
+        height, width = self.input_size
+        clahe = self._get_clahe()
+        cv2 = _get_cv2()
+        gray_images = np.empty((len(images), height, width), dtype=np.uint8)
+        for index, img in enumerate(images):
+            if img.mode != "RGB":
+                img = img.convert("RGB")
+            if img.height > img.width:
+                img = img.transpose(Image.Transpose.ROTATE_90)  # Поворот на 90°
+            img = img.resize((width, height), Image.Resampling.BILINEAR)
+            gray_images[index] = clahe.apply(cv2.cvtColor(np.asarray(img), cv2.COLOR_RGB2GRAY))
+
+        # Все три канала модели - одно и то же изображение после CLAHE.
+        image_tensor = torch.empty((len(images), 3, height, width), dtype=torch.float32)
+        torch.div(torch.from_numpy(gray_images).unsqueeze(1).expand(-1, 3, -1, -1), 255.0, out=image_tensor)
+        return image_tensor
+
+    def _get_clahe(self):
+        clahe = getattr(self.thread_local, "clahe", None)
+        if clahe is None:
+            clahe = _get_cv2().createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
+            self.thread_local.clahe = clahe
+        return clahe
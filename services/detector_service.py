@@ -1,9 +1,21 @@
+import io
 import os
+import json
+import math
+import base64
+import heapq
+import hashlib
+import time
 import uuid
 import torch
 import asyncio
 import logging
+import shutil
+import zipfile
+import functools
+import contextlib
 from typing import Dict
+from concurrent.futures import ThreadPoolExecutor
 
 from PIL import Image, ImageOps
 from fastapi import UploadFile
@@ -11,184 +23,1077 @@ from fastapi import UploadFile
 from datetime import datetime, timedelta
 from models.recognizer import NumbersRecognizer
 from models.detector import ElectricMeterDetector
+from services.process_engine import ProcessInferenceEngine
+from services.inference_pipeline import InferencePipeline
+from services.video_pipeline import VideoPipeline, select_frames
+from services.job_store import QUEUED, PROCESSING, PROCESSED, FAILED, FINAL_STATUSES, create_job_store
 
-from common.exceptions import ImageNotFoundException
+from common.cache import ResultCache
+from common.storage_quota import StorageQuota
+from common.metrics import MetricsRegistry
+from common.stats import RollingStats
+from common.exceptions import ImageNotFoundException, ServiceOverloadedException, ImageTooLargeException
 
 class DetectorService:
     TEMP_IMAGE_FOLDER = "temp"
+    # Расширения изображений, которые берутся из zip архивов при пакетной загрузке.
+    BULK_IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+    # Расширения видео для POST /video (остальные файлы считаются кадрами или zip архивами кадров).
+    VIDEO_EXTENSIONS = (".mp4", ".avi", ".mov", ".mkv", ".webm", ".m4v")
     
-    def __init__(self, detector_model_path, recognizer_model_path):
+    def __init__(self, detector_model_path, recognizer_model_path, batch_size=8, batch_wait_ms=10, ocr_batch_size=32,
+                 inference_workers=1, torch_threads=0, max_queue_size=64,
+                 result_cache_size=256, result_cache_ttl=600, result_cache_max_bytes=256 * 1024 * 1024,
+                 in_memory=True, result_image_quality=85,
+                 inference_backend="thread", inference_processes=2, process_torch_threads=1, process_restart_on_crash=True,
+                 detector_backend="eager", recognizer_backend="eager", recognizer_quantize=False,
+                 ocr_decoder="flashlight", ocr_beam_size=8, detection_decode_size=640,
+                 rotated_detection=True, ocr_flip_check=True,
+                 job_store="memory", job_store_path=None, job_poll_interval=0.05,
+                 temp_storage_max_files=10000, temp_storage_max_bytes=1024 * 1024 * 1024,
+                 warmup_rounds=1, video_keyframe_interval=10, video_frame_step=1, video_max_frames=300,
+                 video_min_votes=5, video_stable_share=0.7):
         self.detector = None
         self.recognizer = None
         self.detector_model_path = detector_model_path
         self.recognizer_model_path = recognizer_model_path
-        self.processing_queue = asyncio.Queue()
-        # Хранилище информации о файлах: {file_id: {"original": path, "processed": path, "timestamp": datetime}}
-        self.processed_images: Dict[str, Dict[str, str]] = {}
-        self.processing_tasks: Dict[str, asyncio.Task] = {}  # uuid -> task
+        # Очередь ограничена: при заполнении новые загрузки отклоняются (см. handle_upload).
+        self.max_queue_size = max(1, max_queue_size)
+        # Хранилище заданий (см. services/job_store.py): состояние, исходное изображение и результат обработки.
+        # Задания в состоянии queued образуют очередь на обработку. Хранилище SQLite общее для нескольких процессов сервиса.
+        self.job_store = create_job_store(job_store, job_store_path)
+        # Блокирующие вызовы хранилища (SQLite) выполняются в отдельном потоке, а не в event loop (см. _store).
+        self.store_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="job-store") if self.job_store.blocking else None
+        # Период проверки хранилища на задания и результаты других процессов (сек).
+        self.job_poll_interval = job_poll_interval
+        # Появились задания в очереди / задания забраны из очереди на обработку.
+        self.jobs_available = asyncio.Event()
+        self.jobs_claimed = asyncio.Event()
+        # Завершение обработки изображения: uuid -> future, выставляется после сохранения результата или ошибки.
+        self.completion_futures: Dict[str, asyncio.Future] = {}
         self.file_lifetime = 120 # 2 минуты
+        self.cleanup_interval = 60
+        # Ограничение на загруженные изображения (во временной папке или в памяти): количество и суммарный размер.
+        # Изображения обработанных заданий вытесняются по LRU, необработанные не вытесняются.
+        self.source_quota = StorageQuota(temp_storage_max_files, temp_storage_max_bytes)
+        # Режим без диска: загруженное изображение хранится и декодируется из памяти.
+        self.in_memory = in_memory
+        # Изображение с результатом детекции формируется только по запросу /result и хранится в JPEG с этим качеством.
+        self.result_image_quality = result_image_quality
+        self.render_tasks: Dict[str, asyncio.Future] = {}  # uuid -> задача формирования изображения
+        # Параметры формирования батча для детектора: не больше batch_size изображений
+        # и не дольше batch_wait_ms ожидания следующего изображения.
+        self.batch_size = max(1, batch_size)
+        self.batch_wait_ms = max(0, batch_wait_ms)
+        self.ocr_batch_size = ocr_batch_size
+        # Способ выполнения моделей (см. models/backends.py).
+        self.detector_backend = detector_backend
+        self.recognizer_backend = recognizer_backend
+        self.recognizer_quantize = recognizer_quantize
+        # Способ декодирования CTC (см. common/decoder.py).
+        self.ocr_decoder = ocr_decoder
+        self.ocr_beam_size = ocr_beam_size
+        # JPEG для детекции декодируется уменьшенным до этого размера стороны (0 - в полном разрешении).
+        self.detection_decode_size = detection_decode_size
+        # Каскад ориентации для повернутых фотографий (см. InferencePipeline): детекция на поворотах 90/180/270°,
+        # если область показаний не найдена, и сравнение распознавания области с ее поворотом на 180°.
+        self.rotated_detection = rotated_detection
+        self.ocr_flip_check = ocr_flip_check
+        # Параметры обработки видео и последовательностей кадров (см. VideoPipeline).
+        self.video_options = {
+            "keyframe_interval": video_keyframe_interval,
+            "frame_step": video_frame_step,
+            "max_frames": video_max_frames,
+            "min_votes": video_min_votes,
+            "stable_share": video_stable_share
+        }
+        self.batch_size_stats = RollingStats()
+        self.queue_wait_stats = RollingStats()
+        # Отдельный пул потоков для инференса с фиксированным количеством потоков.
+        # Одновременно обрабатывается не больше inference_workers батчей.
+        self.inference_workers = max(1, inference_workers)
+        self.torch_threads = torch_threads
+        self.inference_executor = None
+        # Инференс в потоках сервиса ("thread") или в пуле процессов ("process").
+        self.inference_backend = inference_backend
+        self.inference_processes = inference_processes
+        self.process_torch_threads = process_torch_threads
+        self.process_restart_on_crash = process_restart_on_crash
+        self.pipeline = None
+        self.process_engine = None
+        # Количество проходов прогрева моделей при старте (0 - без прогрева).
+        self.warmup_rounds = warmup_rounds
+        # Сервис готов принимать изображения после загрузки и прогрева моделей (см. GET /health/ready).
+        self.ready = False
+        # Время этапов старта сервиса (сек).
+        self.startup_timings = {}
+        self.inference_slots = asyncio.Semaphore(self.inference_workers)
+        # Видео обрабатываются в пуле инференса без очереди: одновременно не больше inference_workers видео,
+        # остальные отклоняются (см. handle_video). Время обработки последнего видео (сек) нужно для расчета Retry-After.
+        self.video_slots = asyncio.Semaphore(self.inference_workers)
+        self.video_seconds = None
+        self.in_flight = 0
+        # Оценка скорости обработки (изображений в секунду), нужна для расчета Retry-After.
+        self.service_rate = None
+        # Кэш результатов по хэшу содержимого изображения: повторные загрузки не обрабатываются заново.
+        self.result_cache = ResultCache(result_cache_size, result_cache_ttl, result_cache_max_bytes,
+                                        sizeof=lambda result: len(result["result_image"] or b""))
+        # Одинаковые изображения, которые сейчас обрабатываются: хэш -> uuid обрабатываемого изображения.
+        # Дубликаты ждут его результат в отдельных задачах.
+        self.inflight_duplicates: Dict[str, str] = {}
+        # Обратный индекс: uuid обрабатываемого изображения -> хэш (см. _release_inflight).
+        self.inflight_hashes: Dict[str, str] = {}
+        # Одинаковые изображения принимаются по очереди (хэш -> [asyncio.Lock, количество загрузок]): между поиском
+        # обрабатываемого изображения и его регистрацией есть вызовы хранилища, и без блокировки одновременные
+        # загрузки не видят друг друга.
+        self.accept_locks: Dict[str, list] = {}
+        self.duplicate_tasks = set()
+        # Задания пакетной загрузки: job_id -> {"status", "total", "submitted", "processed", "failed", ...}
+        self.bulk_jobs: Dict[str, dict] = {}
+        # Куча (timestamp, job_id) завершенных заданий пакетной загрузки для удаления по времени.
+        self.bulk_expiry = []
+        # Метрики в формате Prometheus (GET /metrics): время этапов обработки и состояние сервиса.
+        self.metrics = MetricsRegistry()
+        self.stage_durations = self.metrics.histogram("emeter_stage_duration_seconds",
+                                                      "Duration of the image processing stages.", label_names=("stage",))
+        self.batch_sizes = self.metrics.histogram("emeter_batch_size", "Number of images in a detector batch.",
+                                                  buckets=(1, 2, 4, 8, 16, 32, 64))
+        self.cascade_outcomes = self.metrics.counter("emeter_orientation_cascade_total",
+                                                     "Outcomes of the orientation cascade stages.", label_names=("stage", "outcome"))
+        self.metrics.gauge("emeter_queue_size", "Images waiting in the processing queue.", lambda: self.job_store.count(QUEUED))
+        self.metrics.gauge("emeter_in_flight", "Images being processed.", lambda: self.in_flight)
+        self.metrics.gauge("emeter_processed_images", "Entries in the processed images storage.", lambda: self.job_store.count())
+        self.metrics.gauge("emeter_temp_dir_bytes", "Size of the files in the temporary folder.", self._temp_dir_bytes)
+        self.metrics.gauge("emeter_ready", "Whether the models are loaded and warmed up.", lambda: int(self.ready))
         self.logger = logging.getLogger(__name__)
 
+    # Загрузка и прогрев моделей. Модели загружаются в отдельных потоках (процессах), поэтому во время загрузки
+    # сервис отвечает на запросы (GET /health/live), а изображения принимает только после готовности.
     async def initialize(self):
         self.logger.info("Initialize DetectorService")
-        self.detector = await ElectricMeterDetector(self.detector_model_path).load_model()
-        self.recognizer = await NumbersRecognizer(self.recognizer_model_path).load_model()
+        started_at = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        # Ограничиваем количество потоков torch, чтобы потоки пула не конкурировали за ядра.
+        if self.torch_threads > 0:
+            torch.set_num_threads(self.torch_threads)
+        self.inference_executor = ThreadPoolExecutor(max_workers=self.inference_workers, thread_name_prefix="inference")
+        if self.inference_backend == "process":
+            # Модели загружаются в процессах-воркерах, здесь детектор нужен только для рисования результата.
+            self.detector = ElectricMeterDetector(self.detector_model_path, self.detector_backend)
+            self.process_engine = ProcessInferenceEngine(self.detector_model_path, self.recognizer_model_path,
+                                                         workers=self.inference_processes,
+                                                         threads_per_worker=self.process_torch_threads,
+                                                         ocr_batch_size=self.ocr_batch_size,
+                                                         restart_on_crash=self.process_restart_on_crash,
+                                                         detector_backend=self.detector_backend,
+                                                         recognizer_backend=self.recognizer_backend,
+                                                         recognizer_quantize=self.recognizer_quantize,
+                                                         ocr_decoder=self.ocr_decoder,
+                                                         ocr_beam_size=self.ocr_beam_size,
+                                                         detection_decode_size=self.detection_decode_size,
+                                                         rotated_detection=self.rotated_detection,
+                                                         ocr_flip_check=self.ocr_flip_check,
+                                                         warmup_rounds=self.warmup_rounds)
+            # Модели загружаются и прогреваются в каждом процессе при старте пула.
+            await loop.run_in_executor(None, self.process_engine.start)
+            self.startup_timings["load_models"] = time.perf_counter() - started_at
+        else:
+            await loop.run_in_executor(None, self._load_models)
+            self.startup_timings["load_models"] = time.perf_counter() - started_at
+            if self.warmup_rounds > 0:
+                self.startup_timings["warmup"] = await loop.run_in_executor(self.inference_executor, self.pipeline.warmup,
+                                                                            self.warmup_rounds)
         # Создаем временную папку для изображений.
         os.makedirs(self.TEMP_IMAGE_FOLDER, exist_ok=True)
         # Запуск обработчика очереди.
         asyncio.create_task(self._process_queue())
         # Очистка файлов и внутренних словарей
         asyncio.create_task(self._cleanup_old_files())
+        self.startup_timings["total"] = time.perf_counter() - started_at
+        self.ready = True
+        self.logger.info(f"DetectorService is ready. Startup timings: {self.startup_timings}.")
         return self
 
+    # Загрузка моделей для инференса в потоках сервиса (выполняется не в event loop).
+    def _load_models(self):
+        self.detector = ElectricMeterDetector(self.detector_model_path, self.detector_backend).load()
+        self.recognizer = NumbersRecognizer(self.recognizer_model_path, self.ocr_batch_size,
+                                            self.recognizer_backend, self.recognizer_quantize,
+                                            self.ocr_decoder, self.ocr_beam_size).load()
+        self.pipeline = InferencePipeline(self.detector, self.recognizer, self.detection_decode_size,
+                                          self.rotated_detection, self.ocr_flip_check)
+
+    # Состояние готовности сервиса и время этапов старта (мс).
+    def get_readiness(self):
+        return {
+            "status": "ready" if self.ready else "starting",
+            "startup_ms": {stage: round(duration * 1000, 3) for stage, duration in self.startup_timings.items()}
+        }
+
     # Очистка ресурсов.
     async def cleanup(self):
         if self.detector:
             self.detector.release_resource()
-            self.recognizer.release_resource()
             self.detector = None
+        if self.recognizer:
+            self.recognizer.release_resource()
             self.recognizer = None
+        if self.process_engine:
+            self.process_engine.shutdown()
+            self.process_engine = None
+        if self.inference_executor:
+            self.inference_executor.shutdown(wait=False, cancel_futures=True)
+            self.inference_executor = None
+        await self._store(self.job_store.close)
+        if self.store_executor:
+            self.store_executor.shutdown(wait=False)
+            self.store_executor = None
 
     async def handle_upload(self, file: UploadFile):
+        # Время этапов загрузки (сек), сохраняется вместе с изображением для трассировки.
+        started_at = time.perf_counter()
+        content = await file.read()
+        trace = {"upload_read": self._observe_stage("upload_read", started_at)}
+        return await self._accept_image(file.filename, content, trace)
+
+    # Принимает загруженное изображение: результат из кэша, ожидание результата такого же изображения
+    # или постановка в очередь на обработку. При заполненной очереди загрузка отклоняется (ServiceOverloadedException),
+    # а с wait_for_slot=True ожидает свободного места в очереди.
+    async def _accept_image(self, original_filename: str, content: bytes, trace: dict, wait_for_slot=False):
+        self._check_ready()
         # Генерируем идентификатор для изображения.
         image_uuid = str(uuid.uuid4())
-        original_filename = file.filename
         self.logger.info(f"Upload file {original_filename} with ID {image_uuid}.")
         # Извлекаем extension файла
         filename_without_ext, file_ext = os.path.splitext(original_filename)
-        # Сохраняем изображение во временную папку.
-        file_path = os.path.join(self.TEMP_IMAGE_FOLDER, f"{image_uuid}{file_ext}")
-        
-        with open(file_path, "wb") as buffer:
-            buffer.write(await file.read())
+        started_at = time.perf_counter()
+        content_hash = hashlib.sha256(content).hexdigest()
+        trace["hash"] = self._observe_stage("hash", started_at)
+        async with self._accept_lock(content_hash):
+            return await self._accept_new_image(image_uuid, file_ext, content, content_hash, trace, wait_for_slot)
+
+    # Блокировка приема изображений с хэшем content_hash. Удаляется, когда ее не ждет ни одна загрузка.
+    @contextlib.asynccontextmanager
+    async def _accept_lock(self, content_hash: str):
+        entry = self.accept_locks.setdefault(content_hash, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                self.accept_locks.pop(content_hash, None)
+
+    async def _accept_new_image(self, image_uuid: str, file_ext: str, content: bytes, content_hash: str, trace: dict,
+                                wait_for_slot: bool):
+        # С общим хранилищем изображение, которое считается обрабатываемым, мог обработать и удалить другой процесс.
+        original_uuid = self.inflight_duplicates.get(content_hash)
+        if original_uuid is not None and not await self._check_inflight(original_uuid):
+            original_uuid = None
+
+        # Такое же изображение уже обработано - отдаем результат из кэша.
+        cached_result = self.result_cache.get(content_hash)
+        if cached_result is not None:
+            await self._add_image(image_uuid, file_ext, content, content_hash, trace,
+                                  store_source=cached_result["result_image"] is None, status=PROCESSED, result=cached_result)
+            self.logger.info(f"File {image_uuid} found in the result cache.")
+            return {"uuid": image_uuid, "status": "processed"}
+
+        # Такое же изображение сейчас обрабатывается - ждем его результат.
+        if original_uuid is not None:
+            await self._add_image(image_uuid, file_ext, content, content_hash, trace, status=PROCESSING)
+            task = asyncio.create_task(self._finish_duplicate(image_uuid, original_uuid))
+            self.duplicate_tasks.add(task)
+            task.add_done_callback(self.duplicate_tasks.discard)
+            self.logger.info(f"File {image_uuid} is a duplicate of an image being processed.")
+            return {"uuid": image_uuid, "status": "queued"}
+
+        # Проверяем, что очередь не переполнена, до сохранения файла.
+        if wait_for_slot:
+            await self._wait_for_queue_slot()
+        else:
+            await self._check_admission()
+        # Добавляем в хранилище заданий, задание в состоянии queued попадает в очередь на обработку.
+        await self._add_image(image_uuid, file_ext, content, content_hash, trace)
+        self.inflight_duplicates[content_hash] = image_uuid
+        self.inflight_hashes[image_uuid] = content_hash
+        self.jobs_available.set()
+        self.logger.info(f"Put file {image_uuid} to processing queue.")
+        return {"uuid": image_uuid, "status": "queued"}
+
+    # Добавляет изображение в хранилище. Изображение хранится в памяти или во временной папке (in_memory=False),
+    # оно нужно для обработки и для формирования изображения с результатом.
+    # Изображение с готовым результатом (result) добавляется сразу обработанным.
+    async def _add_image(self, image_uuid: str, file_ext: str, content: bytes, content_hash: str, trace: dict, store_source=True,
+                         status=QUEUED, result=None):
+        file_path = None
+        image_bytes = None
+        if store_source:
+            await self._reserve_source(image_uuid, len(content), pinned=result is None)
+        if store_source and self.in_memory:
+            image_bytes = content
+        elif store_source:
+            # Сохраняем изображение во временную папку.
+            started_at = time.perf_counter()
+            file_path = os.path.join(self.TEMP_IMAGE_FOLDER, f"{image_uuid}{file_ext}")
+            with open(file_path, "wb") as buffer:
+                buffer.write(content)
+            trace["file_write"] = self._observe_stage("file_write", started_at)
 
-        # Добавляем в хранилище файлов.
-        self.processed_images[image_uuid] = {
+        job = {
+                "status": status,
                 "input_path": file_path,
-                "output_path": None,
+                "image_bytes": image_bytes,
                 "uploaded_at": datetime.now(),
                 "timestamp": None,
-                "values": None
+                "values": None,
+                "value_confidences": None,
+                "detections": None,
+                "result_image": None,
+                "content_hash": content_hash,
+                "error": None,
+                "trace": dict(trace)
             }
-        # Добавляем в очередь на обработку.
-        await self.processing_queue.put(image_uuid)
-        self.logger.info(f"Put file {image_uuid} to processing queue.")
-        return {"uuid": image_uuid, "status": "queued"}
+        if result is not None:
+            job.update({
+                "timestamp": datetime.now(),
+                "values": result["values"],
+                "value_confidences": result["value_confidences"],
+                "detections": result["detections"],
+                "result_image": result["result_image"]
+            })
+        await self._store(self.job_store.add, image_uuid, job)
+        # Future создается после добавления: до этого задания нет в хранилище, и проверка заданий
+        # (см. _cleanup_expired) не должна считать его удаленным.
+        if result is None:
+            self.completion_futures[image_uuid] = asyncio.get_running_loop().create_future()
+
+    # Вызов хранилища заданий. Блокирующее хранилище вызывается в store_executor, чтобы не останавливать event loop.
+    async def _store(self, function, *args):
+        if self.store_executor is None:
+            return function(*args)
+        return await asyncio.get_running_loop().run_in_executor(self.store_executor, function, *args)
+
+    # Задание из хранилища (только поля fields, по умолчанию все).
+    # Если задания нет (не загружено или уже удалено) - ImageNotFoundException.
+    async def _get_job(self, image_uuid: str, message="Image not processed or not found.", fields: tuple = None):
+        job = await self._store(self.job_store.get, image_uuid, fields)
+        if job is None:
+            raise ImageNotFoundException(message=message)
+        return job
 
     async def check_status(self, image_uuid: str):
-        if image_uuid in self.processed_images:
-            process_image = self.processed_images[image_uuid]
-            if process_image["output_path"] != None:
-                return {"status": "processed"}
-            else:
-                return {"status": "processing"}
-        if image_uuid in self.processing_tasks:
-            return {"status": "processing"}
-        else:
-            raise ImageNotFoundException(message="Image not found.")
+        try:
+            status = (await self._get_job(image_uuid, "Image not found.", ("status",)))["status"]
+        except ImageNotFoundException:
+            await self._release_inflight(image_uuid, fill_cache=False)
+            raise
+        if status in FINAL_STATUSES:
+            await self._release_inflight(image_uuid)
+        # Для клиентов задание в очереди уже обрабатывается.
+        return {"status": PROCESSING if status == QUEUED else status}
 
+    # Возвращает изображение с результатом детекции (JPEG). Изображение формируется при первом запросе.
     async def get_result(self, image_uuid: str):
-        if image_uuid not in self.processed_images:
+        process_image = await self._get_job(image_uuid, fields=("status", "result_image", "detections", "content_hash"))
+        if process_image["status"] != PROCESSED:
             raise ImageNotFoundException(message="Image not processed or not found.")
+        if process_image["result_image"] is not None:
+            return process_image["result_image"]
 
-        process_image = self.processed_images[image_uuid]
-        output_path = process_image["output_path"]
-        if output_path == None:
-            raise ImageNotFoundException(message="Image not processed or not found.")
-        return output_path
+        render_task = self.render_tasks.get(image_uuid)
+        if render_task is None:
+            source = self._get_source(await self._get_job(image_uuid, fields=("image_bytes", "input_path")))
+            if source is None:
+                raise ImageNotFoundException(message="Source image was removed from the temporary storage.")
+            self.source_quota.touch(image_uuid)
+            render_task = asyncio.get_running_loop().run_in_executor(None, self._render_result, source, process_image["detections"])
+            self.render_tasks[image_uuid] = render_task
+            try:
+                process_image["result_image"] = await render_task
+            finally:
+                self.render_tasks.pop(image_uuid, None)
+            await self._store(functools.partial(self.job_store.update, image_uuid, result_image=process_image["result_image"]))
+            # Сохраняем изображение в кэше результатов для повторных загрузок.
+            content_hash = process_image["content_hash"]
+            cached_result = self.result_cache.get(content_hash)
+            if cached_result is not None and cached_result["result_image"] is None:
+                self.result_cache.put(content_hash, {**cached_result, "result_image": process_image["result_image"]})
+            return process_image["result_image"]
+        return await render_task
 
     async def get_values(self, image_uuid: str):
-        if image_uuid not in self.processed_images:
-            raise ImageNotFoundException(message="Image not processed or not found.")
-        
-        process_image = self.processed_images[image_uuid]
+        process_image = await self._get_job(image_uuid, fields=("values",))
         return process_image["values"]
 
+    # Время этапов обработки изображения в миллисекундах (для отладки).
+    async def get_trace(self, image_uuid: str):
+        trace = (await self._get_job(image_uuid, fields=("trace",)))["trace"]
+        return {stage: round(duration * 1000, 3) for stage, duration in trace.items()}
+
+    # Результат детекции: распознанные значения и найденные области (класс, confidence, координаты).
+    async def get_details(self, image_uuid: str):
+        process_image = await self._get_job(image_uuid, fields=("values", "value_confidences", "detections"))
+        return {"values": process_image["values"], "value_confidences": process_image["value_confidences"],
+                "detections": process_image["detections"]}
+
+    # Ожидание завершения обработки изображения. Возвращает итоговый статус.
+    # Изображение, загруженное в этом процессе, ждем по его future. Если хранилище общее, задание может обработать
+    # другой процесс сервиса, поэтому хранилище дополнительно проверяется раз в job_poll_interval.
+    async def wait_for_result(self, image_uuid: str, timeout=None):
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while True:
+            status = await self.check_status(image_uuid)
+            if status["status"] != PROCESSING:
+                self._complete(image_uuid)
+                return status
+            future = self.completion_futures.get(image_uuid)
+            wait = self.job_poll_interval if future is None or self.job_store.shared else None
+            if deadline is not None:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    raise asyncio.TimeoutError()
+                wait = remaining if wait is None else min(wait, remaining)
+            if future is None:
+                await asyncio.sleep(wait)
+                continue
+            try:
+                await asyncio.wait_for(asyncio.shield(future), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    # Синхронная детекция: загрузка, ожидание обработки и возврат результата одним запросом.
+    async def detect(self, file: UploadFile, include_image=False, timeout=None):
+        upload_result = await self.handle_upload(file)
+        image_uuid = upload_result["uuid"]
+        status = await self.wait_for_result(image_uuid, timeout)
+        result = {"uuid": image_uuid, "status": status["status"]}
+        if status["status"] == FAILED:
+            # Ошибка обработки изображения (например, файл не является изображением).
+            result["error"] = (await self._get_job(image_uuid, fields=("error",)))["error"]
+        if status["status"] != PROCESSED:
+            return result
+        result.update(await self.get_details(image_uuid))
+        if include_image:
+            result_image = await self.get_result(image_uuid)
+            result["image"] = base64.b64encode(result_image).decode("ascii")
+        return result
+
+    # Пакетная загрузка: несколько изображений и/или zip архивов с изображениями.
+    # Изображения читаются по одному и ставятся в общую очередь (батчи детектора собираются из нее же),
+    # при заполненной очереди ожидается свободное место, а не возвращается ошибка.
+    # Возвращает идентификатор задания и асинхронный генератор строк NDJSON: первая строка - задание,
+    # затем результат каждого изображения по мере обработки, последняя - итог задания.
+    async def handle_bulk(self, files: list):
+        self._check_ready()
+        job_id = str(uuid.uuid4())
+        loop = asyncio.get_running_loop()
+        # Изображения читаются после возврата из роута, а FastAPI к этому времени закрывает UploadFile,
+        # поэтому задание забирает файлы загрузки себе (без копирования).
+        bulk_files = self._take_bulk_files(files)
+        try:
+            entries = await loop.run_in_executor(None, self._list_bulk_entries, bulk_files)
+        except BaseException:
+            self._close_bulk_files(bulk_files)
+            raise
+        job = {
+            "job_id": job_id,
+            "status": "processing",
+            "total": len(entries),
+            "submitted": 0,
+            "processed": 0,
+            "failed": 0,
+            "created_at": datetime.now(),
+            "timestamp": None
+        }
+        self.bulk_jobs[job_id] = job
+        self.logger.info(f"Bulk job {job_id} started with {len(entries)} images.")
+
+        async def lines():
+            results = asyncio.Queue()
+            producer = asyncio.create_task(self._run_bulk_job(job, entries, bulk_files, results))
+            try:
+                yield self._format_line(self.get_job(job_id))
+                while True:
+                    line = await results.get()
+                    if line is None:
+                        break
+                    yield self._format_line({"job_id": job_id, **line})
+                yield self._format_line(self.get_job(job_id))
+            finally:
+                # Клиент отключился до завершения задания: прекращаем загрузку оставшихся изображений.
+                if not producer.done():
+                    producer.cancel()
+                    job["status"] = "cancelled"
+                    job["timestamp"] = datetime.now()
+
+        return job_id, lines()
+
+    # Показание счетчика по видео (один файл с расширением из VIDEO_EXTENSIONS) или по последовательности кадров
+    # (изображения и/или zip архивы с изображениями, кадры в порядке загрузки и в порядке файлов в архиве).
+    # Видео обрабатывается одним заданием в пуле инференса. При заполненной очереди изображений или занятых слотах видео
+    # запрос отклоняется (ServiceOverloadedException), а не ждет.
+    async def handle_video(self, files: list):
+        self._check_ready()
+        await self._check_admission()
+        if self.video_slots.locked():
+            retry_after = max(1, math.ceil(self.video_seconds or 1))
+            self.logger.warning(f"All video slots are busy, video rejected. Retry after {retry_after} s.")
+            raise ServiceOverloadedException(message="Service is overloaded. Try again later.", retry_after=retry_after)
+        async with self.video_slots:
+            return await self._process_video(files)
+
+    async def _process_video(self, files: list):
+        loop = asyncio.get_running_loop()
+        started_at = time.perf_counter()
+        video_path = None
+        try:
+            filename_without_ext, file_ext = os.path.splitext(files[0].filename or "")
+            if len(files) == 1 and file_ext.lower() in self.VIDEO_EXTENSIONS:
+                # OpenCV читает видео только из файла.
+                video_path = os.path.join(self.TEMP_IMAGE_FOLDER, f"{uuid.uuid4()}{file_ext}")
+                await loop.run_in_executor(None, self._save_upload, files[0], video_path)
+                source = video_path
+            else:
+                # Кадры читаются по мере обработки (см. iter_image_frames), из zip архивов читается только оглавление.
+                entries = await loop.run_in_executor(None, self._list_bulk_entries, [(file.filename, file.file) for file in files])
+                source = [read for file_name, read in entries]
+            # Видео обрабатывается в пуле инференса вместе с батчами изображений (без слота inference_slots,
+            # его занимает ожидающий изображений обработчик очереди, поэтому число видео ограничено video_slots).
+            result = await loop.run_in_executor(self.inference_executor, self._sync_process_video, source)
+        finally:
+            if video_path is not None:
+                self._remove_file(video_path)
+        for stage in ("detect", "track", "ocr"):
+            self.stage_durations.observe(result["timings"][stage], stage=f"video_{stage}")
+        result["timings"] = {stage: round(duration * 1000, 3) for stage, duration in result["timings"].items()}
+        self.video_seconds = self._observe_stage("video_total", started_at)
+        result["timings"]["total"] = round(self.video_seconds * 1000, 3)
+        self.logger.info(f"Video processed: {result['frames']} frames, {result['keyframes']} keyframes, value {result['value']}.")
+        return result
+
+    def _save_upload(self, file: UploadFile, file_path: str):
+        file.file.seek(0)
+        with open(file_path, "wb") as buffer:
+            shutil.copyfileobj(file.file, buffer)
+
+    # Прогресс задания пакетной загрузки.
+    def get_job(self, job_id: str):
+        job = self.bulk_jobs.get(job_id)
+        if job is None:
+            raise ImageNotFoundException(message="Job not found.")
+        return {key: value for key, value in job.items() if key not in ("created_at", "timestamp")}
+
+    # Забирает файлы загрузки (их уже сохранил разбор multipart запроса): [(имя файла, файловый объект)].
+    # UploadFile получает пустой файл, его и закрывает FastAPI, а забранные файлы закрывает задание (см. _run_bulk_job).
+    def _take_bulk_files(self, files: list):
+        bulk_files = []
+        for file in files:
+            bulk_files.append((file.filename, file.file))
+            file.file = io.BytesIO()
+        return bulk_files
+
+    def _close_bulk_files(self, bulk_files: list):
+        for file_name, file in bulk_files:
+            file.close()
+
+    # Изображения пакетной загрузки: (имя файла, функция чтения содержимого).
+    # На входе [(имя файла, файловый объект)].
+    # Из zip архивов читается только оглавление, содержимое изображений читается при постановке в очередь.
+    def _list_bulk_entries(self, files: list):
+        entries = []
+        for file_name, file in files:
+            if zipfile.is_zipfile(file):
+                file.seek(0)
+                archive = zipfile.ZipFile(file)
+                for info in archive.infolist():
+                    if info.is_dir() or info.filename.startswith("__MACOSX/"):
+                        continue
+                    if info.filename.lower().endswith(self.BULK_IMAGE_EXTENSIONS):
+                        entries.append((info.filename, functools.partial(archive.read, info)))
+            else:
+                entries.append((file_name, functools.partial(self._read_file, file)))
+        return entries
+
+    def _read_file(self, file):
+        file.seek(0)
+        return file.read()
+
+    async def _run_bulk_job(self, job: dict, entries: list, bulk_files: list, results: asyncio.Queue):
+        loop = asyncio.get_running_loop()
+        waiters = set()
+        try:
+            for file_name, read in entries:
+                try:
+                    started_at = time.perf_counter()
+                    content = await loop.run_in_executor(None, read)
+                    trace = {"upload_read": self._observe_stage("upload_read", started_at)}
+                    upload_result = await self._accept_image(os.path.basename(file_name), content, trace, wait_for_slot=True)
+                except Exception as e:
+                    self.logger.error(f"Error occurred while reading the image {file_name} of the bulk job {job['job_id']}: {e}", exc_info=True)
+                    job["failed"] += 1
+                    await results.put({"file": file_name, "uuid": None, "status": "failed", "error": str(e)})
+                    continue
+                job["submitted"] += 1
+                waiter = asyncio.create_task(self._bulk_result(job, file_name, upload_result["uuid"], results))
+                waiters.add(waiter)
+                waiter.add_done_callback(waiters.discard)
+            if waiters:
+                await asyncio.gather(*waiters)
+            job["status"] = "done"
+        except asyncio.CancelledError:
+            for waiter in waiters:
+                waiter.cancel()
+            raise
+        finally:
+            self._close_bulk_files(bulk_files)
+            job["timestamp"] = datetime.now()
+            heapq.heappush(self.bulk_expiry, (job["timestamp"], job["job_id"]))
+            await results.put(None)
+
+    # Ожидает результат изображения пакетной загрузки и передает его в поток результатов задания.
+    async def _bulk_result(self, job: dict, file_name: str, image_uuid: str, results: asyncio.Queue):
+        status = await self.wait_for_result(image_uuid)
+        line = {"file": file_name, "uuid": image_uuid, "status": status["status"]}
+        if status["status"] == "processed":
+            job["processed"] += 1
+            details = await self.get_details(image_uuid)
+            line.update({"values": details["values"], "value_confidences": details["value_confidences"]})
+        else:
+            job["failed"] += 1
+            line["error"] = (await self._store(self.job_store.get, image_uuid, ("error",)) or {}).get("error")
+        await results.put(line)
+
+    def _format_line(self, data: dict):
+        return json.dumps(data) + "\n"
+
+    # Поток событий (server-sent events) со статусом обработки изображения.
+    # Первое событие - текущий статус, последнее - итоговый статус вместе с результатом.
+    async def stream_status(self, image_uuid: str, keepalive_interval=15):
+        status = await self.check_status(image_uuid)
+
+        async def events():
+            current_status = status
+            if current_status["status"] == "processed":
+                current_status = {**current_status, **(await self.get_details(image_uuid))}
+            yield self._format_event(current_status)
+            while current_status["status"] == "processing":
+                try:
+                    current_status = await self.wait_for_result(image_uuid, keepalive_interval)
+                except asyncio.TimeoutError:
+                    # Комментарий SSE, чтобы соединение не закрывалось по таймауту.
+                    yield ": keepalive\n\n"
+                    continue
+                except ImageNotFoundException:
+                    current_status = {"status": "not_found"}
+                if current_status["status"] == "processed":
+                    current_status = {**current_status, **(await self.get_details(image_uuid))}
+                yield self._format_event(current_status)
+
+        return events()
+
+    def _format_event(self, data: dict):
+        return f"data: {json.dumps(data)}\n\n"
+
+    # Статистика для подбора размера батча и времени ожидания.
+    async def get_stats(self):
+        return {
+            "batch_size": self.batch_size,
+            "batch_wait_ms": self.batch_wait_ms,
+            "queue_size": await self._store(self.job_store.count, QUEUED),
+            "job_store": type(self.job_store).__name__,
+            "max_queue_size": self.max_queue_size,
+            "in_flight": self.in_flight,
+            "inference_workers": self.inference_workers,
+            "service_rate": self.service_rate,
+            "inference_backend": self.inference_backend,
+            "process_restarts": self.process_engine.restarts if self.process_engine else 0,
+            "result_cache": self.result_cache.stats(),
+            "temp_storage": self.source_quota.stats(),
+            "batches": self.batch_size_stats.summary(),
+            "queue_wait_ms": self.queue_wait_stats.summary(),
+            "orientation_cascade": self._cascade_stats()
+        }
+
+    # Отклоняет загрузку, пока модели не загружены и не прогреты.
+    def _check_ready(self):
+        if not self.ready:
+            raise ServiceOverloadedException(message="Service is starting. Try again later.", retry_after=1)
+
+    # Метрики в формате Prometheus. Метрики состояния читают хранилище заданий, поэтому формируются через _store.
+    async def render_metrics(self):
+        return await self._store(self.metrics.render)
+
+    # Отклоняет загрузку, если очередь на обработку заполнена.
+    async def _check_admission(self):
+        queued = await self._store(self.job_store.count, QUEUED)
+        if queued >= self.max_queue_size:
+            retry_after = self._estimate_retry_after(queued)
+            self.logger.warning(f"Processing queue is full, upload rejected. Retry after {retry_after} s.")
+            raise ServiceOverloadedException(message="Service is overloaded. Try again later.", retry_after=retry_after)
+
+    # Оценка времени (в секундах), за которое будет обработана текущая очередь из queued заданий.
+    def _estimate_retry_after(self, queued: int):
+        pending = queued + self.in_flight
+        if not self.service_rate:
+            return 1
+        return max(1, math.ceil(pending / self.service_rate))
+
+    # Обновление скорости обработки (экспоненциальное сглаживание).
+    def _update_service_rate(self, batch_size: int, elapsed: float):
+        if elapsed <= 0:
+            return
+        rate = batch_size / elapsed * self.inference_workers
+        if self.service_rate is None:
+            self.service_rate = rate
+        else:
+            self.service_rate = 0.8 * self.service_rate + 0.2 * rate
+
     # Функция для обработки очереди. Работает как фоновая задача.
     async def _process_queue(self):
         while True:
-            image_uuid = await self.processing_queue.get()
-            image_data = self.processed_images[image_uuid]
-            input_path = image_data["input_path"]
-
-            # Создаем задачу для обработки изображения и сохраняем ссылку на нее.
-            task = asyncio.create_task(self._process_image(image_uuid, input_path))
-            self.processing_tasks[image_uuid] = task
-            # В очереди на обработку помечаем задачу, как выполненную.
-            self.processing_queue.task_done()
-
-    # Функция обработки конретного изображения.
-    async def _process_image(self, image_uuid: str, input_path: str):
+            # Ждем свободный слот в пуле инференса, пока изображения копятся в очереди.
+            await self.inference_slots.acquire()
+            try:
+                batch = await self._collect_batch()
+            except BaseException:
+                self.inference_slots.release()
+                raise
+            self.in_flight += len(batch)
+            self.batch_size_stats.add(len(batch))
+            self.batch_sizes.observe(len(batch))
+            # Создаем задачу для обработки батча.
+            asyncio.create_task(self._process_batch(batch))
+
+    # Собирает батч из очереди: ждет первое изображение, затем добирает остальные,
+    # пока не наберется batch_size или не истечет batch_wait_ms.
+    # Задания забираются из хранилища атомарно, поэтому с общим хранилищем каждое задание обрабатывает один процесс.
+    async def _collect_batch(self):
+        loop = asyncio.get_running_loop()
+        batch = []
+        deadline = None
+        while len(batch) < self.batch_size:
+            self.jobs_available.clear()
+            claimed = await self._claim_jobs(self.batch_size - len(batch))
+            if claimed:
+                batch.extend(claimed)
+                if deadline is None:
+                    deadline = loop.time() + self.batch_wait_ms / 1000
+                continue
+            timeout = None
+            if deadline is not None:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+            if self.job_store.shared:
+                # Задания других процессов не выставляют jobs_available, проверяем хранилище периодически.
+                timeout = self.job_poll_interval if timeout is None else min(timeout, self.job_poll_interval)
+            try:
+                await asyncio.wait_for(self.jobs_available.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return batch
+
+    # Забирает из очереди до limit заданий и записывает время их ожидания в очереди.
+    async def _claim_jobs(self, limit: int) -> list:
+        claimed = await self._store(self.job_store.claim, limit)
+        if claimed:
+            self.jobs_claimed.set()
+        now = datetime.now()
+        for image_uuid in claimed:
+            job = await self._store(self.job_store.get, image_uuid, ("uploaded_at", "trace"))
+            queue_wait = (now - job["uploaded_at"]).total_seconds()
+            self.queue_wait_stats.add(queue_wait * 1000)
+            self.stage_durations.observe(queue_wait, stage="queue_wait")
+            await self._store(functools.partial(self.job_store.update, image_uuid, trace={**job["trace"], "queue_wait": queue_wait}))
+        return claimed
+
+    # Ожидает свободного места в очереди на обработку.
+    async def _wait_for_queue_slot(self):
+        while await self._store(self.job_store.count, QUEUED) >= self.max_queue_size:
+            self.jobs_claimed.clear()
+            try:
+                await asyncio.wait_for(self.jobs_claimed.wait(), self.job_poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    # Функция обработки батча изображений.
+    async def _process_batch(self, batch: list):
+        content_hashes = {}
         try:
-            def sync_process_image():
-                img = self._open_image(input_path)
-                detector_result = self.detector.process_image(image_uuid, img)
-                if detector_result is None:
-                    return [], detector_result
-                indicator_indices = torch.isclose(detector_result.boxes.cls, torch.tensor(self.detector.indicator_class_index)).nonzero()
-                if len(indicator_indices) <= 0:
-                    return [], detector_result
-                indicator_indices = indicator_indices.flatten().cpu().numpy().astype(int)
-                indicator_boxes = detector_result.boxes.xyxy[indicator_indices].cpu().numpy().astype(int)
-                indicator_images = []
-                for j, bbox in enumerate(indicator_boxes):
-                    x1, y1, x2, y2 = bbox
-                    cropped_img = img.crop((x1, y1, x2, y2))
-                    indicator_images.append(cropped_img)
-                if len(indicator_images) == 0:
-                    return [], detector_result
-                
-                indicator_values = self.recognizer.parse_indicator_values(indicator_images)
-                return indicator_values, detector_result
-            
-            values, detector_result = await asyncio.get_event_loop().run_in_executor(None, sync_process_image)
-            
-            file_dir, file_ext = os.path.splitext(input_path)
-            output_path = os.path.join(self.TEMP_IMAGE_FOLDER, f"processed_{image_uuid}{file_ext}")
-            detector_image = detector_result.plot()
-            result_image = Image.fromarray(detector_image[..., ::-1])
-            result_image.save(output_path)
-            self.processed_images[image_uuid] = {
-                "input_path": input_path,
-                "output_path": output_path,
-                "timestamp": datetime.now(),
-                "values": values
-            }
-            self.logger.info(f"File {image_uuid} processed.")
+            jobs = [await self._store(self.job_store.get, image_uuid, ("content_hash", "image_bytes", "input_path"))
+                    for image_uuid in batch]
+            content_hashes = {image_uuid: job["content_hash"] for image_uuid, job in zip(batch, jobs)}
+            sources = [self._get_source(job) for job in jobs]
+            started_at = time.perf_counter()
+            results = await asyncio.get_event_loop().run_in_executor(self.inference_executor, self._sync_process_batch, sources)
+            inference_time = time.perf_counter() - started_at
+            self._update_service_rate(len(batch), inference_time)
+            for image_uuid, result in zip(batch, results):
+                if result is None:
+                    await self._mark_failed(image_uuid, "Image can't be opened.")
+                    continue
+                try:
+                    await self._record_timings(image_uuid, {**result.pop("timings", {}), "inference": inference_time})
+                    self._record_cascade(result.pop("cascade", None), len(result["values"]))
+                    result = {**result, "result_image": None}
+                    await self._save_result(image_uuid, result)
+                    self.result_cache.put(content_hashes[image_uuid], result)
+                except Exception as e:
+                    self.logger.error(f"Error occurred while saving the result of the image {image_uuid}: {e}", exc_info=True)
+                    await self._mark_failed(image_uuid, str(e))
         except Exception as e:
-            self.logger.error(f"Error occurred while processing the image {image_uuid}: {e}", exc_info=True)
+            self.logger.error(f"Error occurred while processing the batch {batch}: {e}", exc_info=True)
+            for image_uuid in batch:
+                await self._mark_failed(image_uuid, str(e))
             raise
         finally:
-            self.processing_tasks.pop(image_uuid, None)
+            self.in_flight -= len(batch)
+            self.inference_slots.release()
+            for image_uuid in batch:
+                # Новые загрузки такого же изображения берут результат из кэша (он заполнен выше).
+                await self._release_inflight(image_uuid, fill_cache=False)
+
+    # Резервирует место для загруженного изображения. Если места нет, вытесняет изображения обработанных заданий,
+    # а если и этого недостаточно - отклоняет загрузку (ServiceOverloadedException).
+    async def _reserve_source(self, image_uuid: str, size: int, pinned: bool):
+        # Изображение больше всего ограничения не поместится и после повторной попытки (ImageTooLargeException).
+        if not self.source_quota.fits(size):
+            raise ImageTooLargeException(message=f"Image is larger than the temporary storage limit "
+                                                 f"({self.source_quota.max_bytes} bytes).")
+        evicted = self.source_quota.add(image_uuid, size, pinned)
+        if evicted is None and self.job_store.shared:
+            await self._sync_source_quota()
+            evicted = self.source_quota.add(image_uuid, size, pinned)
+        if evicted is None:
+            retry_after = self._estimate_retry_after(await self._store(self.job_store.count, QUEUED))
+            self.logger.warning(f"Temporary storage is full, upload rejected. Retry after {retry_after} s.")
+            raise ServiceOverloadedException(message="Service is overloaded. Try again later.", retry_after=retry_after)
+        for evicted_uuid in evicted:
+            await self._evict_source(evicted_uuid)
+
+    # Удаляет загруженное изображение обработанного задания. Результат остается, но изображение с результатом
+    # больше нельзя сформировать, если оно еще не сформировано.
+    async def _evict_source(self, image_uuid: str):
+        job = await self._store(self.job_store.get, image_uuid, ("input_path",))
+        if job is None:
+            return
+        self._remove_file(job["input_path"])
+        await self._store(functools.partial(self.job_store.update, image_uuid, input_path=None, image_bytes=None))
+        self.logger.info(f"Source image of {image_uuid} evicted from the temporary storage.")
+
+    # С общим хранилищем задания этого процесса может завершить и удалить другой процесс:
+    # снимаем закрепление с завершенных заданий и убираем из учета удаленные.
+    async def _sync_source_quota(self):
+        for image_uuid in list(self.source_quota.entries):
+            # Закрепленное изображение без future еще добавляется в хранилище (см. _add_image).
+            if image_uuid in self.source_quota.pinned and image_uuid not in self.completion_futures:
+                continue
+            job = await self._store(self.job_store.get, image_uuid, ("status",))
+            if job is None:
+                self._complete(image_uuid)
+                self.source_quota.remove(image_uuid)
+            elif job["status"] in (PROCESSED, FAILED):
+                self._complete(image_uuid)
+
+    # Сообщаем ожидающим (/detect, /events), что обработка завершена.
+    def _complete(self, image_uuid: str):
+        self.source_quota.unpin(image_uuid)
+        future = self.completion_futures.pop(image_uuid, None)
+        if future is not None and not future.done():
+            future.set_result(True)
+
+    # Снимает изображение image_uuid с учета обрабатываемых: новые загрузки такого же изображения его больше не ждут,
+    # ожидание завершения и закрепление загруженного изображения снимаются (см. _complete). С fill_cache=True результат обработанного изображения добавляется в кэш результатов: изображение мог обработать
+    # другой процесс сервиса (общее хранилище), тогда кэш этого процесса не заполнен.
+    async def _release_inflight(self, image_uuid: str, fill_cache=True):
+        self._complete(image_uuid)
+        content_hash = self.inflight_hashes.pop(image_uuid, None)
+        if content_hash is None:
+            return
+        if self.inflight_duplicates.get(content_hash) == image_uuid:
+            self.inflight_duplicates.pop(content_hash)
+        if fill_cache:
+            job = await self._store(self.job_store.get, image_uuid,
+                                    ("status", "values", "value_confidences", "detections", "result_image"))
+            if job is not None and job["status"] == PROCESSED:
+                self.result_cache.put(content_hash, {key: job[key] for key in
+                                                     ("values", "value_confidences", "detections", "result_image")})
+
+    # Проверяет, что изображение image_uuid еще обрабатывается. Завершенное или удаленное снимается с учета обрабатываемых
+    # (см. _release_inflight).
+    async def _check_inflight(self, image_uuid: str) -> bool:
+        job = await self._store(self.job_store.get, image_uuid, ("status",))
+        if job is not None and job["status"] not in FINAL_STATUSES:
+            return True
+        await self._release_inflight(image_uuid, fill_cache=job is not None)
+        return False
+
+    # Ожидает обработку изображения original_uuid и передает его результат дубликату, загруженному во время обработки.
+    async def _finish_duplicate(self, image_uuid: str, original_uuid: str):
+        try:
+            status = await self.wait_for_result(original_uuid)
+            original = await self._store(self.job_store.get, original_uuid,
+                                         ("values", "value_confidences", "detections", "result_image", "error"))
+            if status["status"] == PROCESSED and original is not None:
+                await self._save_result(image_uuid, original)
+            else:
+                await self._mark_failed(image_uuid, (original or {}).get("error") or "Image processing failed.")
+        except Exception as e:
+            self.logger.error(f"Error occurred while saving the result of the image {image_uuid}: {e}", exc_info=True)
+            await self._mark_failed(image_uuid, str(e))
+        finally:
+            self._complete(image_uuid)
+
+    # Синхронная обработка батча: один вызов детектора на все изображения, затем распознавание показаний.
+    # Изображения декодируются в конвейере обработки. Для изображений, которые не удалось открыть, возвращается None.
+    def _sync_process_batch(self, sources: list):
+        if self.process_engine is not None:
+            return self.process_engine.process_images(sources)
+        return self.pipeline.process_images(sources)
 
-    # Удаляет файлы старше file_lifetime секунд.
+    # Синхронная обработка видео или последовательности кадров (см. VideoPipeline).
+    def _sync_process_video(self, source):
+        if self.process_engine is not None:
+            if isinstance(source, str):
+                return self.process_engine.process_video(source, self.video_options)
+            # В процессы пула передается содержимое кадров: читаются только кадры, которые будут обработаны.
+            frames = select_frames(source, self.video_options["frame_step"], self.video_options["max_frames"])
+            return self.process_engine.process_video([read() for read in frames], {**self.video_options, "frame_step": 1})
+        return VideoPipeline(self.detector, self.recognizer, **self.video_options).process(source)
+
+    # Сохраняет результат обработки: распознанные значения и найденные области.
+    async def _save_result(self, image_uuid: str, result: dict):
+        saved = await self._store(functools.partial(self.job_store.transition, image_uuid, (PROCESSING,), PROCESSED,
+                                                    timestamp=datetime.now(),
+                                                    values=result["values"],
+                                                    value_confidences=result["value_confidences"],
+                                                    detections=result["detections"],
+                                                    result_image=result["result_image"]))
+        if saved:
+            self.logger.info(f"File {image_uuid} processed.")
+
+    # Формирует изображение с выделенными областями детекции и кодирует его в JPEG.
+    def _render_result(self, source, detections: list):
+        started_at = time.perf_counter()
+        img = self._open_image(source)
+        result_image = self.detector.render(img, detections)
+        buffer = io.BytesIO()
+        result_image.save(buffer, format="JPEG", quality=self.result_image_quality)
+        self._observe_stage("render", started_at)
+        return buffer.getvalue()
+
+    # Записывает время этапа, начатого в started_at (time.perf_counter), в гистограмму. Возвращает время этапа (сек).
+    def _observe_stage(self, stage: str, started_at: float) -> float:
+        duration = time.perf_counter() - started_at
+        self.stage_durations.observe(duration, stage=stage)
+        return duration
+
+    # Время этапов обработки изображения (сек): в гистограммы и в трассировку изображения.
+    # total - от загрузки до получения результата.
+    async def _record_timings(self, image_uuid: str, timings: dict):
+        process_image = await self._get_job(image_uuid, fields=("uploaded_at", "trace"))
+        timings["total"] = (datetime.now() - process_image["uploaded_at"]).total_seconds()
+        for stage, duration in timings.items():
+            self.stage_durations.observe(duration, stage=stage)
+        await self._store(functools.partial(self.job_store.update, image_uuid, trace={**process_image["trace"], **timings}))
+
+    # Учитывает этапы каскада ориентации изображения (см. InferencePipeline.process_images):
+    # detection - upright (область найдена сразу, повороты не проверялись), rotated (найдена на повороте),
+    # not_found (не найдена); ocr - для каждого значения upright или flipped (взято с области, повернутой на 180°).
+    def _record_cascade(self, cascade: dict, values_count: int):
+        if cascade is None:
+            return
+        if cascade["rotation"] != 0:
+            detection = "rotated"
+        elif cascade["rotated_detection"] or values_count == 0:
+            detection = "not_found"
+        else:
+            detection = "upright"
+        self.cascade_outcomes.inc(stage="detection", outcome=detection)
+        flipped = cascade["flipped_values"]
+        if flipped > 0:
+            self.cascade_outcomes.inc(flipped, stage="ocr", outcome="flipped")
+        if values_count > flipped:
+            self.cascade_outcomes.inc(values_count - flipped, stage="ocr", outcome="upright")
+
+    def _cascade_stats(self):
+        stats = {}
+        for (stage, outcome), count in self.cascade_outcomes.values().items():
+            stats.setdefault(stage, {})[outcome] = count
+        return stats
+
+    # Размер файлов во временной папке (байт).
+    def _temp_dir_bytes(self) -> int:
+        total = 0
+        try:
+            with os.scandir(self.TEMP_IMAGE_FOLDER) as entries:
+                for entry in entries:
+                    if entry.is_file(follow_symlinks=False):
+                        total += entry.stat(follow_symlinks=False).st_size
+        except FileNotFoundError:
+            pass
+        return total
+
+    # Помечает изображение, как обработанное с ошибкой.
+    async def _mark_failed(self, image_uuid: str, error: str):
+        await self._store(functools.partial(self.job_store.transition, image_uuid, (QUEUED, PROCESSING), FAILED,
+                                            error=error, timestamp=datetime.now()))
+
+    # Удаляет изображения, обработанные больше file_lifetime секунд назад, и завершенные задания пакетной загрузки.
+    # Ошибка очистки не останавливает фоновую задачу.
     async def _cleanup_old_files(self):
         while True:
-            await asyncio.sleep(60)  # Проверка каждые 30 секунд
-            self.logger.info("Started cleanup old files.")
-            current_time = datetime.now()
-            to_delete = []
-    
-            for image_uuid, file_data in self.processed_images.items():
-                file_time = file_data["timestamp"]
-                if (current_time - file_time) > timedelta(seconds=self.file_lifetime):
-                    self.logger.info(f"Planning to delete the file with ID {image_uuid}, current time {current_time}, file_time {file_time}.")
-                    try:
-                        if os.path.exists(file_data["input_path"]):
-                            os.unlink(file_data["input_path"])
-                        if os.path.exists(file_data["output_path"]):
-                            os.unlink(file_data["output_path"])
-                        to_delete.append(image_uuid)
-                    except Exception as e:
-                        self.logger.error(f"Ошибка удаления файла {image_uuid}: {e}", exc_info=True)
-    
-            for image_uuid in to_delete:
-                self.logger.info(f"File with ID {image_uuid} deleted.")
-                self.processed_images.pop(image_uuid, None)
-            self.logger.info("Finished cleanup old files.")
+            await asyncio.sleep(self.cleanup_interval)
+            try:
+                await self._cleanup_expired(datetime.now())
+            except Exception as e:
+                self.logger.error(f"Error occurred while cleaning up old files: {e}", exc_info=True)
+
+    # Устаревшие задания берутся из индекса по времени завершения (см. JobStore.expired), а не перебором всех заданий.
+    async def _cleanup_expired(self, current_time: datetime):
+        self.logger.info("Started cleanup old files.")
+        before = current_time - timedelta(seconds=self.file_lifetime)
+        for image_uuid, input_path in await self._store(self.job_store.expired, before):
+            self._remove_file(input_path)
+            await self._store(self.job_store.delete, image_uuid)
+            self.source_quota.remove(image_uuid)
+            self._complete(image_uuid)
+            self.logger.info(f"File with ID {image_uuid} deleted.")
+
+        # Изображения этого процесса, которые завершил или удалил другой процесс сервиса, снимаем с учета обрабатываемых
+        # и завершаем их ожидание, даже если результат никто не ждал (клиент проверял только GET /status).
+        for image_uuid in set(self.inflight_hashes) | set(self.completion_futures):
+            await self._check_inflight(image_uuid)
+
+        # Завершенные задания пакетной загрузки удаляем так же, как файлы.
+        while self.bulk_expiry and self.bulk_expiry[0][0] < before:
+            timestamp, job_id = heapq.heappop(self.bulk_expiry)
+            self.bulk_jobs.pop(job_id, None)
+        self.logger.info("Finished cleanup old files.")
+
+    def _remove_file(self, file_path):
+        if not file_path:
+            return
+        try:
+            os.unlink(file_path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            self.logger.error(f"Ошибка удаления файла {file_path}: {e}", exc_info=True)
+
+    # Источник изображения: содержимое в памяти или путь к файлу во временной папке.
+    def _get_source(self, process_image: dict):
+        if process_image["image_bytes"] is not None:
+            return process_image["image_bytes"]
+        return process_image["input_path"]
 
-    def _open_image(self, input_path: str):
-        image = Image.open(input_path)
+    def _open_image(self, source):
+        if isinstance(source, bytes):
+            source = io.BytesIO(source)
+        image = Image.open(source)
         # Применяем настройки из EXIF, иначе изображение может быть повернутым после открытия.
         image = ImageOps.exif_transpose(image)
         return image
@@ -0,0 +1,165 @@
+import time
+import logging
+import numpy as np
+from PIL import Image
+
+from models.recognizer import NumbersRecognizer
+from models.detector import ElectricMeterDetector
+from common.image_source import ImageSource
+
+class InferencePipeline():
+    """
+    Обработка батча изображений: детекция областей и распознавание показаний.
+    Используется в потоках сервиса и в процессах ProcessInferenceEngine.
+    Повернутые фотографии обрабатываются каскадом: если на исходном изображении область показаний не найдена,
+    детектор запускается одним батчем на поворотах 90/180/270°, а OCR сравнивает каждую область с ее поворотом на 180°.
+    """
+    # Повороты изображения против часовой стрелки для повторной детекции.
+    ROTATIONS = {90: Image.Transpose.ROTATE_90, 180: Image.Transpose.ROTATE_180, 270: Image.Transpose.ROTATE_270}
+
+    def __init__(self, detector: ElectricMeterDetector, recognizer: NumbersRecognizer, detection_decode_size=0,
+                 rotated_detection=True, ocr_flip_check=True):
+        """
+        rotated_detection: искать область показаний на повернутых изображениях, если на исходном ее нет
+        ocr_flip_check: распознавать каждую область показаний также повернутой на 180°
+        """
+        self.detector = detector
+        self.recognizer = recognizer
+        # Минимальный размер стороны JPEG при декодировании для детекции (0 - декодировать полностью, см. ImageSource).
+        self.detection_decode_size = detection_decode_size
+        self.rotated_detection = rotated_detection
+        self.ocr_flip_check = ocr_flip_check
+        self.logger = logging.getLogger(__name__)
+
+    # Один вызов детектора на все изображения, затем распознавание показаний для всех найденных областей.
+    # На входе для каждого изображения bytes, путь к файлу или PIL Image.
+    # На выходе для каждого изображения {"values", "value_confidences", "detections", "timings", "cascade"},
+    # для отсутствующих изображений и изображений, которые не удалось открыть, - None.
+    # timings - время этапов обработки изображения (сек): decode и crop - для самого изображения,
+    # detect, detect_rotated, ocr_preprocess, ocr_forward, ctc_decode - для всего батча
+    # (detect_rotated - только у изображений, для которых выполнялась детекция на поворотах).
+    # cascade - этапы каскада ориентации: rotated_detection (выполнялась ли детекция на поворотах),
+    # rotation (поворот, на котором найдена область показаний), flipped_values (значения с областей, повернутых на 180°).
+    def process_images(self, images: list) -> list:
+        sources = []
+        decode_timings = []
+        for img in images:
+            started_at = time.perf_counter()
+            sources.append(self._open_source(img))
+            decode_timings.append(time.perf_counter() - started_at)
+        opened = [index for index, source in enumerate(sources) if source is not None]
+        started_at = time.perf_counter()
+        detector_results = self.detector.process_images([sources[index].image for index in opened])
+        detect_timing = time.perf_counter() - started_at
+        detections = {index: self._get_detections(detector_result, sources[index])
+                      for index, detector_result in zip(opened, detector_results)}
+
+        # Изображения без области показаний проверяем на поворотах (один вызов детектора на все повороты).
+        rotations = {index: 0 for index in opened}
+        missing = [index for index in opened if not self._has_indicator(detections[index])]
+        rotated_timing = None
+        if self.rotated_detection and missing:
+            started_at = time.perf_counter()
+            rotated_results = iter(self.detector.process_images([sources[index].image.transpose(transpose)
+                                                                 for index in missing
+                                                                 for transpose in self.ROTATIONS.values()]))
+            for index in missing:
+                best_confidence = 0.0
+                for rotation in self.ROTATIONS:
+                    rotated_detections = self._get_detections(next(rotated_results), sources[index], rotation)
+                    confidence = self._indicator_confidence(rotated_detections)
+                    if confidence > best_confidence:
+                        best_confidence = confidence
+                        detections[index] = rotated_detections
+                        rotations[index] = rotation
+            rotated_timing = time.perf_counter() - started_at
+
+        results = []
+        indicator_images = {}
+        for index, source in enumerate(sources):
+            if source is None:
+                results.append(None)
+                continue
+            started_at = time.perf_counter()
+            indicator_images[index] = self._crop_indicators(source, detections[index], rotations[index])
+            timings = {"decode": decode_timings[index], "detect": detect_timing, "crop": time.perf_counter() - started_at}
+            rotated_detection = rotated_timing is not None and index in missing
+            if rotated_detection:
+                timings["detect_rotated"] = rotated_timing
+            cascade = {"rotated_detection": rotated_detection, "rotation": rotations[index], "flipped_values": 0}
+            results.append({"values": [], "value_confidences": [], "detections": detections[index],
+                            "timings": timings, "cascade": cascade})
+
+        # Распознаем показания сразу для всех изображений батча.
+        ocr_timings = {}
+        flipped = {}
+        indicator_values = self.recognizer.recognize_batch(indicator_images, with_confidence=True, timings=ocr_timings,
+                                                           check_flipped=self.ocr_flip_check, flipped=flipped)
+        for index, values in indicator_values.items():
+            results[index]["values"] = [value for value, confidences in values]
+            results[index]["value_confidences"] = [confidences for value, confidences in values]
+            results[index]["timings"].update(ocr_timings)
+            results[index]["cascade"]["flipped_values"] = flipped[index]
+        return results
+
+    # Прогрев моделей перед приемом запросов: rounds проходов детектора и OCR модели на батчах из одного изображения
+    # (основное время первого вызова - инициализация, а не вычисления). Возвращает время прогрева (сек).
+    def warmup(self, rounds=1) -> float:
+        started_at = time.perf_counter()
+        for _ in range(rounds):
+            self.detector.warmup(1)
+            self.recognizer.warmup(1)
+        return time.perf_counter() - started_at
+
+    def _open_source(self, img):
+        if img is None:
+            return None
+        try:
+            return ImageSource(img, self.detection_decode_size).open()
+        except Exception as e:
+            self.logger.error(f"Error occurred while opening the image: {e}", exc_info=True)
+            return None
+
+    def _has_indicator(self, detections: list) -> bool:
+        return any(d["class_index"] == self.detector.indicator_class_index for d in detections)
+
+    # Наибольший confidence области показаний (0, если области нет).
+    def _indicator_confidence(self, detections: list) -> float:
+        return max((d["confidence"] for d in detections if d["class_index"] == self.detector.indicator_class_index), default=0.0)
+
+    # Вырезает из изображения области с показаниями счетчика (в полном разрешении).
+    # Если область найдена на повернутом изображении, вырезанная область поворачивается так же.
+    def _crop_indicators(self, source: ImageSource, detections: list, rotation=0):
+        indicator_boxes = [[int(c) for c in d["box"]] for d in detections
+                           if d["class_index"] == self.detector.indicator_class_index]
+        crops = source.crop(indicator_boxes, min_size=self.recognizer.input_size[::-1])
+        if rotation != 0:
+            crops = [crop.transpose(self.ROTATIONS[rotation]) for crop in crops]
+        return crops
+
+    # Найденные детектором области: класс, confidence и координаты (x1, y1, x2, y2) в полном разрешении изображения.
+    # rotation - поворот изображения, на котором выполнялась детекция: координаты пересчитываются для исходного изображения.
+    def _get_detections(self, detector_result, source: ImageSource, rotation=0):
+        if detector_result is None or detector_result.boxes is None:
+            return []
+        classes = detector_result.boxes.cls.cpu().numpy().astype(int).tolist()
+        confidences = detector_result.boxes.conf.cpu().numpy().tolist()
+        boxes = detector_result.boxes.xyxy.cpu().numpy()
+        if rotation != 0:
+            boxes = self._unrotate_boxes(boxes, rotation, source.image.size)
+        if source.scale > 1:
+            width, height = source.size
+            boxes = (boxes * source.scale).clip(0, [width, height, width, height])
+        return [{"class": detector_result.names[cls], "class_index": cls, "confidence": conf, "box": box}
+                for cls, conf, box in zip(classes, confidences, boxes.tolist())]
+
+    # Пересчитывает области [x1, y1, x2, y2], найденные на изображении, повернутом на rotation° против часовой стрелки,
+    # в координаты исходного изображения размера size (W, H).
+    def _unrotate_boxes(self, boxes: np.ndarray, rotation: int, size) -> np.ndarray:
+        width, height = size
+        x1, y1, x2, y2 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+        if rotation == 90:
+            return np.stack([width - y2, x1, width - y1, x2], axis=1)
+        if rotation == 180:
+            return np.stack([width - x2, height - y2, width - x1, height - y1], axis=1)
+        return np.stack([y1, height - x2, y2, height - x1], axis=1)
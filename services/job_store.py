@@ -0,0 +1,304 @@
+import json
+import heapq
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from collections import Counter, deque
+from datetime import datetime
+
+# Состояния изображения (задания на обработку): queued -> processing -> processed или failed.
+QUEUED = "queued"
+PROCESSING = "processing"
+PROCESSED = "processed"
+FAILED = "failed"
+FINAL_STATUSES = (PROCESSED, FAILED)
+
+# Поля задания:
+# status, input_path, image_bytes, uploaded_at, timestamp, values, value_confidences, detections,
+# result_image, content_hash, error, trace.
+JOB_FIELDS = ("status", "input_path", "image_bytes", "uploaded_at", "timestamp", "values", "value_confidences",
+              "detections", "result_image", "content_hash", "error", "trace")
+
+class JobStore(ABC):
+    """
+    Хранилище заданий на обработку изображений (состояние, исходное изображение и результат).
+    Переходы между состояниями атомарные: transition меняет состояние, только если задание в ожидаемом состоянии,
+    claim забирает задания из очереди (queued -> processing), так что каждое задание обрабатывает один воркер.
+    Хранилище без какого-либо из методов нельзя создать (TypeError при создании, а не при первом вызове).
+    """
+    # Общее ли хранилище для нескольких процессов (тогда задания других процессов нужно периодически проверять).
+    shared = False
+    # Блокирующие ли вызовы хранилища (диск, ожидание блокировки других процессов): тогда сервис выполняет их вне event loop.
+    blocking = False
+
+    # Добавляет задание.
+    @abstractmethod
+    def add(self, job_id: str, job: dict):
+        raise NotImplementedError
+
+    # Копия задания или None. fields - только эти поля (по умолчанию все).
+    @abstractmethod
+    def get(self, job_id: str, fields: tuple = None):
+        raise NotImplementedError
+
+    # Обновляет поля задания (кроме состояния).
+    @abstractmethod
+    def update(self, job_id: str, **fields):
+        raise NotImplementedError
+
+    # Переводит задание из состояния from_statuses в to_status и обновляет поля. Возвращает True, если переход выполнен.
+    @abstractmethod
+    def transition(self, job_id: str, from_statuses: tuple, to_status: str, **fields) -> bool:
+        raise NotImplementedError
+
+    # Забирает из очереди до limit заданий в порядке добавления (queued -> processing). Возвращает их идентификаторы.
+    @abstractmethod
+    def claim(self, limit: int) -> list:
+        raise NotImplementedError
+
+    # Количество заданий (всех или в состоянии status).
+    @abstractmethod
+    def count(self, status: str = None) -> int:
+        raise NotImplementedError
+
+    # Завершенные задания, обработанные раньше before, в порядке завершения: [(job_id, input_path)].
+    # Просматриваются только такие задания, а не все хранилище. Вызывающий код должен удалить эти задания.
+    @abstractmethod
+    def expired(self, before: datetime) -> list:
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete(self, job_id: str):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class InMemoryJobStore(JobStore):
+    """
+    Хранилище заданий в словаре процесса (по умолчанию). Подходит для одного процесса сервиса.
+    Завершенные задания дополнительно хранятся в куче по времени завершения, чтобы находить устаревшие без обхода словаря.
+    Очередь и количество заданий по состояниям тоже ведутся отдельно, claim и count не обходят словарь.
+    """
+    def __init__(self):
+        self.jobs = {}
+        # Куча (timestamp, job_id) завершенных заданий.
+        self.expiry = []
+        # Идентификаторы заданий в порядке постановки в очередь. Задания, которые уже не в очереди, пропускаются в claim.
+        self.queue = deque()
+        # Количество заданий в каждом состоянии.
+        self.status_counts = Counter()
+        self.lock = threading.Lock()
+
+    def add(self, job_id: str, job: dict):
+        with self.lock:
+            previous = self.jobs.get(job_id)
+            if previous is not None:
+                self.status_counts[previous["status"]] -= 1
+            self.jobs[job_id] = dict(job)
+            self.status_counts[job["status"]] += 1
+            if job["status"] == QUEUED:
+                self.queue.append(job_id)
+            self._index_expiry(job_id, job)
+
+    def get(self, job_id: str, fields: tuple = None):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            if fields is None:
+                return dict(job)
+            return {field: job[field] for field in fields}
+
+    def update(self, job_id: str, **fields):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is not None:
+                job.update(fields)
+
+    def transition(self, job_id: str, from_statuses: tuple, to_status: str, **fields) -> bool:
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or job["status"] not in from_statuses:
+                return False
+            job.update(fields)
+            self._set_status(job, to_status)
+            if to_status == QUEUED:
+                self.queue.append(job_id)
+            self._index_expiry(job_id, job)
+            return True
+
+    def claim(self, limit: int) -> list:
+        claimed = []
+        with self.lock:
+            while self.queue and len(claimed) < limit:
+                job_id = self.queue.popleft()
+                job = self.jobs.get(job_id)
+                # Пропускаем удаленные задания и задания, которые уже вышли из очереди (например, с ошибкой).
+                if job is not None and job["status"] == QUEUED:
+                    self._set_status(job, PROCESSING)
+                    claimed.append(job_id)
+        return claimed
+
+    def count(self, status: str = None) -> int:
+        with self.lock:
+            if status is None:
+                return len(self.jobs)
+            return self.status_counts[status]
+
+    def expired(self, before: datetime) -> list:
+        expired = []
+        with self.lock:
+            while self.expiry and self.expiry[0][0] < before:
+                timestamp, job_id = heapq.heappop(self.expiry)
+                job = self.jobs.get(job_id)
+                # Пропускаем удаленные задания и устаревшие записи кучи.
+                if job is not None and job["status"] in FINAL_STATUSES and job["timestamp"] == timestamp:
+                    expired.append((job_id, job["input_path"]))
+        return expired
+
+    def delete(self, job_id: str):
+        with self.lock:
+            job = self.jobs.pop(job_id, None)
+            if job is not None:
+                self.status_counts[job["status"]] -= 1
+
+    def _set_status(self, job: dict, status: str):
+        self.status_counts[job["status"]] -= 1
+        self.status_counts[status] += 1
+        job["status"] = status
+
+    def _index_expiry(self, job_id: str, job: dict):
+        if job["status"] in FINAL_STATUSES and job["timestamp"] is not None:
+            heapq.heappush(self.expiry, (job["timestamp"], job_id))
+
+class SQLiteJobStore(JobStore):
+    """
+    Хранилище заданий в SQLite (режим WAL) для нескольких процессов сервиса на одном хосте (uvicorn --workers N).
+    Загруженное изображение хранится в базе (BLOB), поэтому задание может обработать любой процесс.
+    Устаревшие задания выбираются по индексу на времени завершения.
+    Вызовы ждут блокировку базы до timeout секунд, поэтому сервис выполняет их вне event loop (blocking),
+    а get читает только нужные поля, без изображений, если они не нужны.
+    """
+    shared = True
+    blocking = True
+    # Поля, которые хранятся в JSON.
+    JSON_FIELDS = ("values", "value_confidences", "detections", "trace")
+    DATETIME_FIELDS = ("uploaded_at", "timestamp")
+
+    def __init__(self, path: str, timeout=30.0):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        columns = ", ".join(f"\"{field}\"" for field in JOB_FIELDS if field != "status")
+        self.connection.execute(f"CREATE TABLE IF NOT EXISTS jobs (seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+                                f"job_id TEXT NOT NULL UNIQUE, status TEXT NOT NULL, {columns})")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, seq)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS jobs_timestamp ON jobs (timestamp)")
+
+    def add(self, job_id: str, job: dict):
+        row = self._to_row(job)
+        names = ", ".join(f"\"{name}\"" for name in row)
+        placeholders = ", ".join("?" for _ in row)
+        with self.lock:
+            self.connection.execute(f"INSERT INTO jobs (job_id, {names}) VALUES (?, {placeholders})", (job_id, *row.values()))
+
+    def get(self, job_id: str, fields: tuple = None):
+        fields = JOB_FIELDS if fields is None else fields
+        with self.lock:
+            cursor = self.connection.execute(f"SELECT {self._columns(fields)} FROM jobs WHERE job_id = ?", (job_id,))
+            row = cursor.fetchone()
+        return self._from_row(row, fields) if row is not None else None
+
+    def update(self, job_id: str, **fields):
+        if len(fields) == 0:
+            return
+        row = self._to_row(fields)
+        assignments = ", ".join(f"\"{name}\" = ?" for name in row)
+        with self.lock:
+            self.connection.execute(f"UPDATE jobs SET {assignments} WHERE job_id = ?", (*row.values(), job_id))
+
+    def transition(self, job_id: str, from_statuses: tuple, to_status: str, **fields) -> bool:
+        row = self._to_row({**fields, "status": to_status})
+        assignments = ", ".join(f"\"{name}\" = ?" for name in row)
+        placeholders = ", ".join("?" for _ in from_statuses)
+        with self.lock:
+            cursor = self.connection.execute(f"UPDATE jobs SET {assignments} WHERE job_id = ? AND status IN ({placeholders})",
+                                             (*row.values(), job_id, *from_statuses))
+            return cursor.rowcount == 1
+
+    def claim(self, limit: int) -> list:
+        with self.lock:
+            # BEGIN IMMEDIATE берет блокировку на запись сразу, другие процессы не заберут те же задания.
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                job_ids = [row[0] for row in self.connection.execute(
+                    "SELECT job_id FROM jobs WHERE status = ? ORDER BY seq LIMIT ?", (QUEUED, limit))]
+                self.connection.executemany("UPDATE jobs SET status = ? WHERE job_id = ?",
+                                            [(PROCESSING, job_id) for job_id in job_ids])
+                self.connection.execute("COMMIT")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+        return job_ids
+
+    def count(self, status: str = None) -> int:
+        with self.lock:
+            if status is None:
+                return self.connection.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+            return self.connection.execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (status,)).fetchone()[0]
+
+    def expired(self, before: datetime) -> list:
+        placeholders = ", ".join("?" for _ in FINAL_STATUSES)
+        with self.lock:
+            return self.connection.execute(f"SELECT job_id, input_path FROM jobs WHERE timestamp < ? "
+                                           f"AND status IN ({placeholders}) ORDER BY timestamp",
+                                           (before.timestamp(), *FINAL_STATUSES)).fetchall()
+
+    def delete(self, job_id: str):
+        with self.lock:
+            self.connection.execute("DELETE FROM jobs WHERE job_id = ?", (job_id,))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def _columns(self, fields: tuple):
+        for field in fields:
+            if field not in JOB_FIELDS:
+                raise ValueError(f"Unknown job field '{field}'.")
+        return ", ".join(f"\"{field}\"" for field in fields)
+
+    def _to_row(self, fields: dict) -> dict:
+        row = {}
+        for name, value in fields.items():
+            if name not in JOB_FIELDS:
+                raise ValueError(f"Unknown job field '{name}'.")
+            if name in self.JSON_FIELDS and value is not None:
+                value = json.dumps(value)
+            elif name in self.DATETIME_FIELDS and value is not None:
+                value = value.timestamp()
+            row[name] = value
+        return row
+
+    def _from_row(self, row, fields: tuple) -> dict:
+        job = dict(zip(fields, row))
+        for name in self.JSON_FIELDS:
+            if job.get(name) is not None:
+                job[name] = json.loads(job[name])
+        for name in self.DATETIME_FIELDS:
+            if job.get(name) is not None:
+                job[name] = datetime.fromtimestamp(job[name])
+        return job
+
+# Поддерживаемые хранилища заданий.
+JOB_STORES = ("memory", "sqlite")
+
+def create_job_store(kind: str, path: str = None) -> JobStore:
+    if kind == "memory":
+        return InMemoryJobStore()
+    if kind == "sqlite":
+        return SQLiteJobStore(path)
+    raise ValueError(f"Unknown job store '{kind}'. Supported job stores: {', '.join(JOB_STORES)}.")
@@ -0,0 +1,165 @@
+import torch
+import logging
+import threading
+import multiprocessing
+
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from models.recognizer import NumbersRecognizer
+from models.detector import ElectricMeterDetector
+from services.inference_pipeline import InferencePipeline
+from services.video_pipeline import VideoPipeline
+
+# Конвейер обработки в процессе-воркере (модели загружаются один раз при старте процесса).
+_worker_pipeline = None
+
+def _init_worker(detector_model_path, recognizer_model_path, ocr_batch_size, torch_threads,
+                 detector_backend, recognizer_backend, recognizer_quantize, ocr_decoder, ocr_beam_size,
+                 detection_decode_size, rotated_detection, ocr_flip_check, warmup_rounds):
+    global _worker_pipeline
+    if torch_threads > 0:
+        torch.set_num_threads(torch_threads)
+    detector = ElectricMeterDetector(detector_model_path, detector_backend).load()
+    recognizer = NumbersRecognizer(recognizer_model_path, ocr_batch_size,
+                                   recognizer_backend, recognizer_quantize,
+                                   ocr_decoder, ocr_beam_size).load()
+    _worker_pipeline = InferencePipeline(detector, recognizer, detection_decode_size, rotated_detection, ocr_flip_check)
+    if warmup_rounds > 0:
+        _worker_pipeline.warmup(warmup_rounds)
+
+# Загруженные изображения (в исходном формате) передаются в процесс-воркер
+# через разделяемую память: (имя, размер), изображения на диске - путем к файлу.
+def _read_shared_images(image_refs: list) -> list:
+    images = []
+    for image_ref in image_refs:
+        if image_ref is None or isinstance(image_ref, str):
+            images.append(image_ref)
+            continue
+        name, size = image_ref
+        # Процессы пула используют resource tracker основного процесса, памятью владеет основной процесс.
+        shm = shared_memory.SharedMemory(name=name)
+        try:
+            images.append(bytes(shm.buf[:size]))
+        finally:
+            shm.close()
+    return images
+
+# Обработка батча в процессе-воркере.
+def _process_shared_images(image_refs: list) -> list:
+    return _worker_pipeline.process_images(_read_shared_images(image_refs))
+
+# Обработка видео (путь к файлу) или последовательности кадров в процессе-воркере (см. VideoPipeline).
+def _process_shared_video(source, options: dict) -> dict:
+    if not isinstance(source, str):
+        source = _read_shared_images(source)
+    return VideoPipeline(_worker_pipeline.detector, _worker_pipeline.recognizer, **options).process(source)
+
+class ProcessInferenceEngine():
+    """
+    Инференс в пуле процессов: каждый процесс загружает модели один раз и использует свое количество потоков torch.
+    Загруженные изображения передаются в процессы через разделяемую память, без сериализации,
+    и декодируются в процессах (см. ImageSource).
+    """
+    def __init__(self, detector_model_path, recognizer_model_path, workers=2, threads_per_worker=1,
+                 ocr_batch_size=32, restart_on_crash=True,
+                 detector_backend="eager", recognizer_backend="eager", recognizer_quantize=False,
+                 ocr_decoder="flashlight", ocr_beam_size=8, detection_decode_size=640,
+                 rotated_detection=True, ocr_flip_check=True, warmup_rounds=0):
+        self.detector_model_path = detector_model_path
+        self.recognizer_model_path = recognizer_model_path
+        self.workers = max(1, workers)
+        self.threads_per_worker = threads_per_worker
+        self.ocr_batch_size = ocr_batch_size
+        self.restart_on_crash = restart_on_crash
+        self.detector_backend = detector_backend
+        self.recognizer_backend = recognizer_backend
+        self.recognizer_quantize = recognizer_quantize
+        self.ocr_decoder = ocr_decoder
+        self.ocr_beam_size = ocr_beam_size
+        self.detection_decode_size = detection_decode_size
+        # Каскад ориентации (см. InferencePipeline).
+        self.rotated_detection = rotated_detection
+        self.ocr_flip_check = ocr_flip_check
+        # Прогрев моделей при старте каждого процесса (в том числе после перезапуска пула).
+        self.warmup_rounds = warmup_rounds
+        self.restarts = 0
+        self.executor = None
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger(__name__)
+
+    def start(self):
+        self.executor = self._create_executor()
+        # Дожидаемся загрузки (и прогрева) моделей во всех процессах.
+        for future in [self.executor.submit(_process_shared_images, []) for _ in range(self.workers)]:
+            future.result()
+        self.logger.info(f"Process inference engine started with {self.workers} workers, {self.threads_per_worker} torch threads per worker.")
+        return self
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    # Обработка батча (блокирующий вызов, выполняется в потоке инференса сервиса).
+    # На входе для каждого изображения bytes или путь к файлу.
+    # Результат такой же, как у InferencePipeline.process_images.
+    def process_images(self, images: list) -> list:
+        return self._submit_shared(_process_shared_images, images)
+
+    # Обработка видео (путь к файлу) или последовательности кадров (bytes или пути к файлам) в процессе-воркере.
+    # Результат такой же, как у VideoPipeline.process.
+    def process_video(self, source, options: dict) -> dict:
+        if isinstance(source, str):
+            return self._submit(_process_shared_video, source, options)
+        return self._submit_shared(_process_shared_video, source, options)
+
+    # Передает изображения в функцию воркера через разделяемую память (см. _read_shared_images).
+    def _submit_shared(self, function, images: list, *args):
+        shms = []
+        try:
+            image_refs = []
+            for img in images:
+                if not isinstance(img, bytes):
+                    image_refs.append(img)
+                    continue
+                shm = shared_memory.SharedMemory(create=True, size=max(1, len(img)))
+                shms.append(shm)
+                shm.buf[:len(img)] = img
+                image_refs.append((shm.name, len(img)))
+            return self._submit(function, image_refs, *args)
+        finally:
+            for shm in shms:
+                shm.close()
+                shm.unlink()
+
+    def _submit(self, function, *args):
+        executor = self.executor
+        try:
+            return executor.submit(function, *args).result()
+        except BrokenProcessPool:
+            if not self.restart_on_crash:
+                raise
+            self.logger.error("Inference worker process crashed, restarting the process pool.")
+            self._restart(executor)
+            return self.executor.submit(function, *args).result()
+
+    # Пересоздает пул процессов (один раз, даже если батчи упали одновременно в нескольких потоках).
+    def _restart(self, broken_executor):
+        with self.lock:
+            if self.executor is not broken_executor:
+                return
+            broken_executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = self._create_executor()
+            self.restarts += 1
+
+    def _create_executor(self):
+        return ProcessPoolExecutor(max_workers=self.workers,
+                                   mp_context=multiprocessing.get_context("spawn"),
+                                   initializer=_init_worker,
+                                   initargs=(self.detector_model_path, self.recognizer_model_path,
+                                             self.ocr_batch_size, self.threads_per_worker,
+                                             self.detector_backend, self.recognizer_backend, self.recognizer_quantize,
+                                             self.ocr_decoder, self.ocr_beam_size, self.detection_decode_size,
+                                             self.rotated_detection, self.ocr_flip_check, self.warmup_rounds))
@@ -0,0 +1,177 @@
+import io
+import math
+import time
+import logging
+
+from PIL import Image, ImageOps
+
+from models.recognizer import NumbersRecognizer
+from models.detector import ElectricMeterDetector
+from common.roi_tracker import RoiTracker
+
+# Кадры видео: PIL Image (RGB) каждого frame_step кадра, не больше max_frames кадров.
+def iter_video_frames(path: str, frame_step=1, max_frames=300):
+    import cv2
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise ValueError("Video can't be opened.")
+    try:
+        index = 0
+        count = 0
+        while count < max_frames and capture.grab():
+            if index % frame_step == 0:
+                ok, frame = capture.retrieve()
+                if not ok:
+                    break
+                yield Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+                count += 1
+            index += 1
+    finally:
+        capture.release()
+
+# Кадры последовательности изображений, которые будут обработаны: каждый frame_step кадр, не больше max_frames кадров.
+def select_frames(images: list, frame_step=1, max_frames=300) -> list:
+    return images[::max(1, frame_step)][:max_frames]
+
+# Кадры последовательности изображений (bytes, путь к файлу или функция чтения содержимого) в исходном порядке:
+# каждый frame_step кадр, не больше max_frames кадров. Содержимое читается по мере обработки кадров,
+# поэтому при ранней остановке оставшиеся кадры не читаются. Изображения, которые не удалось открыть, пропускаются.
+def iter_image_frames(images: list, frame_step=1, max_frames=300):
+    logger = logging.getLogger(__name__)
+    for img in select_frames(images, frame_step, max_frames):
+        try:
+            if callable(img):
+                img = img()
+            if isinstance(img, (bytes, bytearray)):
+                img = io.BytesIO(img)
+            yield ImageOps.exif_transpose(Image.open(img)).convert("RGB")
+        except Exception as e:
+            logger.warning(f"Frame can't be opened and is skipped: {e}")
+
+class VideoPipeline():
+    """
+    Показание счетчика по видео или последовательности кадров.
+    Детектор запускается только на ключевых кадрах (каждый keyframe_interval кадр и при потере области),
+    между ними область показаний отслеживается трекером (RoiTracker). OCR выполняется для области каждого кадра,
+    батчем на каждый интервал между ключевыми кадрами. Показания кадров объединяются голосованием с весом по confidence,
+    обработка останавливается, когда показание устойчиво.
+    """
+    def __init__(self, detector: ElectricMeterDetector, recognizer: NumbersRecognizer, keyframe_interval=10,
+                 frame_step=1, max_frames=300, min_votes=5, stable_share=0.7):
+        """
+        keyframe_interval: максимальное количество кадров между запусками детектора
+        frame_step: обрабатывается каждый frame_step кадр видео или последовательности кадров
+        max_frames: максимальное количество обрабатываемых кадров
+        min_votes, stable_share: показание устойчиво, если за него не меньше min_votes кадров
+                                 и не меньше stable_share суммарного веса всех показаний
+        """
+        self.detector = detector
+        self.recognizer = recognizer
+        self.keyframe_interval = max(1, keyframe_interval)
+        self.frame_step = max(1, frame_step)
+        self.max_frames = max_frames
+        self.min_votes = min_votes
+        self.stable_share = stable_share
+        self.logger = logging.getLogger(__name__)
+
+    # source - путь к видео или список изображений кадров (bytes, путь к файлу или функция чтения содержимого).
+    # На выходе показание с наибольшим весом, его доля в весе всех показаний (confidence), веса показаний
+    # и статистика обработки кадров.
+    def process(self, source) -> dict:
+        if isinstance(source, str):
+            frames = iter_video_frames(source, self.frame_step, self.max_frames)
+        else:
+            frames = iter_image_frames(source, self.frame_step, self.max_frames)
+        return self.process_frames(frames)
+
+    def process_frames(self, frames) -> dict:
+        # Показание -> [суммарный вес, количество кадров].
+        votes = {}
+        stats = {"frames": 0, "keyframes": 0, "tracked_frames": 0, "lost_tracks": 0, "ocr_frames": 0}
+        timings = {"detect": 0.0, "track": 0.0, "ocr": 0.0}
+        # Области кадров текущего интервала: (изображение области, вес области).
+        crops = []
+        tracker = None
+        detection_confidence = 0.0
+        frames_since_keyframe = 0
+        stopped_early = False
+        for frame in frames:
+            stats["frames"] += 1
+            box = None
+            if tracker is not None and frames_since_keyframe < self.keyframe_interval:
+                started_at = time.perf_counter()
+                box = tracker.update(frame)
+                timings["track"] += time.perf_counter() - started_at
+                if box is None:
+                    stats["lost_tracks"] += 1
+                else:
+                    stats["tracked_frames"] += 1
+            if box is None:
+                # Ключевой кадр: ищем область показаний детектором и начинаем ее отслеживать.
+                stats["keyframes"] += 1
+                frames_since_keyframe = 0
+                started_at = time.perf_counter()
+                box, detection_confidence = self._detect_indicator(frame)
+                tracker = RoiTracker(frame, box) if box is not None else None
+                timings["detect"] += time.perf_counter() - started_at
+            frames_since_keyframe += 1
+            if box is not None:
+                weight = detection_confidence * (tracker.score if tracker is not None else 1.0)
+                crops.append((frame.crop(tuple(int(round(c)) for c in box)), max(0.0, weight)))
+            if len(crops) >= self.keyframe_interval:
+                self._vote(crops, votes, stats, timings)
+                crops = []
+                if self._is_stable(votes):
+                    stopped_early = True
+                    break
+        if crops:
+            self._vote(crops, votes, stats, timings)
+
+        total_weight = sum(weight for weight, count in votes.values())
+        value, (weight, count) = max(votes.items(), key=lambda item: item[1][0], default=(None, (0.0, 0)))
+        return {
+            "value": value,
+            "confidence": weight / total_weight if total_weight > 0 else 0.0,
+            "votes": {text: {"weight": weight, "frames": count} for text, (weight, count) in votes.items()},
+            "stopped_early": stopped_early,
+            **stats,
+            "timings": timings
+        }
+
+    # Область показаний с наибольшим confidence на кадре: ([x1, y1, x2, y2], confidence) или (None, 0).
+    def _detect_indicator(self, frame: Image):
+        result = self.detector.process_images([frame])[0]
+        if result is None or result.boxes is None:
+            return None, 0.0
+        best_box, best_confidence = None, 0.0
+        classes = result.boxes.cls.cpu().numpy().tolist()
+        confidences = result.boxes.conf.cpu().numpy().tolist()
+        for cls, confidence, box in zip(classes, confidences, result.boxes.xyxy.cpu().numpy().tolist()):
+            if cls == self.detector.indicator_class_index and confidence > best_confidence:
+                best_box, best_confidence = box, confidence
+        return best_box, best_confidence
+
+    # Распознает области кадров одним батчем и добавляет показания в голосование.
+    # Вес показания - вес области (confidence детекции и трекера), умноженный на среднюю вероятность символов,
+    # если декодер CTC ее возвращает.
+    def _vote(self, crops: list, votes: dict, stats: dict, timings: dict):
+        started_at = time.perf_counter()
+        values = self.recognizer.recognize_batch({0: [crop for crop, weight in crops]}, with_confidence=True)[0]
+        timings["ocr"] += time.perf_counter() - started_at
+        stats["ocr_frames"] += len(crops)
+        for (crop, weight), (value, confidences) in zip(crops, values):
+            text = value[0] if value else ""
+            if text == "":
+                continue
+            if confidences:
+                weight *= math.fsum(confidences) / len(confidences)
+            vote = votes.setdefault(text, [0.0, 0])
+            vote[0] += weight
+            vote[1] += 1
+
+    def _is_stable(self, votes: dict) -> bool:
+        total_weight = sum(weight for weight, count in votes.values())
+        if total_weight <= 0:
+            return False
+        weight, count = max(votes.values(), key=lambda vote: vote[0])
+        return count >= self.min_votes and weight / total_weight >= self.stable_share
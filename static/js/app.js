@@ -18,6 +18,7 @@ $(document).ready(function() {
 
     let currentUuid = null;
     let checkStatusInterval = null;
+    let statusEventSource = null;
 
     // Обработчик изменения файла. Показываем файл в preview области.
     $imageUpload.on('change', function() {
@@ -106,35 +107,78 @@ $(document).ready(function() {
         }
     });
 
-    // Функция проверки статуса обработки
+    // Функция проверки статуса обработки. Статус приходит через server-sent events,
+    // если браузер их не поддерживает или соединение оборвалось - опрашиваем /status.
     function startStatusChecking() {
+        stopStatusChecking();
+        if (!window.EventSource) {
+            startStatusPolling();
+            return;
+        }
+
+        let finished = false;
+        statusEventSource = new EventSource(`/events/${currentUuid}`);
+        statusEventSource.onmessage = async (event) => {
+            const statusData = JSON.parse(event.data);
+            if (statusData.status === 'processing') {
+                $statusBadge.text('Обрабатывается').removeClass().addClass('badge bg-warning text-dark status-badge ms-2');
+                return;
+            }
+            finished = true;
+            stopStatusChecking();
+            await handleStatus(statusData);
+        };
+        statusEventSource.onerror = () => {
+            if (finished) {
+                return;
+            }
+            stopStatusChecking();
+            startStatusPolling();
+        };
+    }
+
+    function stopStatusChecking() {
+        if (statusEventSource) {
+            statusEventSource.close();
+            statusEventSource = null;
+        }
         if (checkStatusInterval) {
             clearInterval(checkStatusInterval);
+            checkStatusInterval = null;
         }
-        
+    }
+
+    function startStatusPolling() {
         checkStatusInterval = setInterval(async () => {
             try {
                 const statusData = await $.get(`/status/${currentUuid}`);
                 
-                if (statusData.status === 'processed') {
-                    // Обработка завершена
-                    $statusBadge.text('Готово').removeClass().addClass('badge bg-success status-badge ms-2');
-                    clearInterval(checkStatusInterval);
-                    
-                    // Загружаем результат
-                    await loadProcessedImage();
-                } else if (statusData.status === 'processing') {
+                if (statusData.status === 'processing') {
                     $statusBadge.text('Обрабатывается').removeClass().addClass('badge bg-warning text-dark status-badge ms-2');
+                } else {
+                    stopStatusChecking();
+                    await handleStatus(statusData);
                 }
                 
             } catch (error) {
                 console.error('Status check error:', error);
-                clearInterval(checkStatusInterval);
+                stopStatusChecking();
                 $statusBadge.text('Ошибка').removeClass().addClass('badge bg-danger status-badge ms-2');
             }
         }, 2000); // Проверяем каждые 2000 млс.
     }
 
+    async function handleStatus(statusData) {
+        if (statusData.status === 'processed') {
+            // Обработка завершена
+            $statusBadge.text('Готово').removeClass().addClass('badge bg-success status-badge ms-2');
+            // Загружаем результат
+            await loadProcessedImage();
+        } else {
+            $statusBadge.text('Ошибка').removeClass().addClass('badge bg-danger status-badge ms-2');
+        }
+    }
+
     // Загрузка обработанного изображения
     async function loadProcessedImage() {
         try {
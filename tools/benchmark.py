@@ -0,0 +1,380 @@
+# Бенчмарк детектора, OCR модели, конвейера обработки и сервиса: перцентили задержки, изображений в секунду,
+# пиковая память процесса (RSS) и распознанные значения. Каждый режим выполняется в отдельном процессе,
+# чтобы пиковая память относилась к этому режиму. Результат сохраняется в JSON
+# и может сравниваться с сохраненным ранее (базовым) результатом.
+# Запуск из корня проекта:
+#   python -m tools.benchmark --modes detector,recognizer,pipeline --repeat 3 --output benchmark.json
+#   python -m tools.benchmark --modes service,http --concurrency 8 --baseline benchmark.json
+import io
+import os
+import sys
+import json
+import time
+import uuid
+import socket
+import asyncio
+import logging
+import argparse
+import platform
+import resource
+import threading
+import multiprocessing
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import torch
+from fastapi import UploadFile
+
+from models.backends import BACKENDS
+from common.stats import RollingStats
+from common.image_source import ImageSource
+from common.exceptions import ServiceOverloadedException
+from models.recognizer import NumbersRecognizer
+from models.detector import ElectricMeterDetector
+from services.detector_service import DetectorService
+from services.inference_pipeline import InferencePipeline
+
+DETECTOR_MODEL_PATH = './models/emeter_yolo11n_v1.pt'
+OCR_MODEL_PATH = './models/emeter_ocr_v1.pt'
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+MODES = ("detector", "recognizer", "pipeline", "service", "http")
+# Параметры, которые должны совпадать с базовым результатом для корректного сравнения.
+COMPARED_CONFIG = ("concurrency", "batch_size", "service_batch_size", "decode_size", "detector_backend",
+                   "recognizer_backend", "inference_backend", "inference_workers")
+
+def load_images(images_dir: str):
+    images = []
+    for file_name in sorted(os.listdir(images_dir)):
+        if file_name.lower().endswith(IMAGE_EXTENSIONS):
+            with open(os.path.join(images_dir, file_name), "rb") as f:
+                images.append((file_name, f.read()))
+    return images
+
+# Уникальное содержимое для каждой загрузки: иначе повторы обслуживаются кэшем результатов сервиса.
+# Декодеры изображений игнорируют данные после конца изображения.
+def unique_payload(data: bytes) -> bytes:
+    return data + uuid.uuid4().bytes
+
+def peak_rss_mb() -> float:
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux возвращает килобайты, macOS - байты.
+    return peak_rss / (1024 * 1024) if sys.platform == "darwin" else peak_rss / 1024
+
+# Выполняет run(item) для всех элементов с заданным количеством одновременных вызовов.
+# Возвращает результаты, задержки (сек) и общее время.
+def run_load(run, items: list, warmup: int, concurrency: int):
+    for item in items[:warmup]:
+        run(item)
+
+    def timed_run(item):
+        started_at = time.perf_counter()
+        result = run(item)
+        return result, time.perf_counter() - started_at
+
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        timed_results = list(executor.map(timed_run, items))
+    elapsed = time.perf_counter() - started_at
+    return [result for result, _ in timed_results], [latency for _, latency in timed_results], elapsed
+
+# Перцентили длительностей (сек) в миллисекундах.
+def summary_ms(durations: list) -> dict:
+    stats = RollingStats(window_size=max(1, len(durations)))
+    for duration in durations:
+        stats.add(duration * 1000)
+    return stats.summary()
+
+def report(latencies: list, elapsed: float, images_count: int) -> dict:
+    return {
+        "images": images_count,
+        "seconds": elapsed,
+        "images_per_second": images_count / elapsed if elapsed > 0 else None,
+        "latency_ms": summary_ms(latencies),
+        "peak_rss_mb": peak_rss_mb()
+    }
+
+# Перцентили времени этапов обработки изображений (timings конвейера обработки) в миллисекундах.
+def stages_report(timings: list) -> dict:
+    durations = {}
+    for image_timings in timings:
+        for stage, duration in image_timings.items():
+            durations.setdefault(stage, []).append(duration)
+    return {stage: summary_ms(stage_durations) for stage, stage_durations in durations.items()}
+
+def batches(items: list, batch_size: int) -> list:
+    return [items[start:start + batch_size] for start in range(0, len(items), batch_size)]
+
+def bench_detector(args, detector: ElectricMeterDetector, images: list):
+    decoded = [ImageSource(data, args.decode_size).open().image for _, data in images] * args.repeat
+    items = batches(decoded, args.batch_size)
+    _, latencies, elapsed = run_load(detector.process_images, items, args.warmup, args.concurrency)
+    return report(latencies, elapsed, len(decoded))
+
+# Области показаний, найденные детектором. Если детектор ничего не нашел, распознаются изображения целиком.
+def collect_crops(pipeline: InferencePipeline, images: list) -> list:
+    crops = []
+    for _, data in images:
+        source = ImageSource(data, pipeline.detection_decode_size).open()
+        detections = pipeline._get_detections(pipeline.detector.process_images([source.image])[0], source)
+        crops.append(pipeline._crop_indicators(source, detections) or [source.image])
+    return crops
+
+def bench_recognizer(args, pipeline: InferencePipeline, images: list):
+    crops = collect_crops(pipeline, images) * args.repeat
+    items = batches(crops, args.batch_size)
+    run = lambda item: pipeline.recognizer.recognize_batch(dict(enumerate(item)))
+    _, latencies, elapsed = run_load(run, items, args.warmup, args.concurrency)
+    result = report(latencies, elapsed, len(crops))
+    result["crops"] = sum(len(image_crops) for image_crops in crops)
+    return result
+
+def bench_pipeline(args, pipeline: InferencePipeline, images: list):
+    items = batches(images * args.repeat, args.batch_size)
+    run = lambda item: pipeline.process_images([data for _, data in item])
+    results, latencies, elapsed = run_load(run, items, args.warmup, args.concurrency)
+    result = report(latencies, elapsed, len(images) * args.repeat)
+    values = {}
+    timings = []
+    for item, item_results in zip(items, results):
+        for (file_name, _), image_result in zip(item, item_results):
+            values[file_name] = image_result["values"] if image_result is not None else None
+            if image_result is not None:
+                timings.append(image_result["timings"])
+    # Этапы detect, detect_rotated, ocr_preprocess, ocr_forward и ctc_decode - время всего батча изображения.
+    result["stages_ms"] = stages_report(timings)
+    return result, values
+
+def service_options(args) -> dict:
+    return {
+        "batch_size": args.service_batch_size,
+        "inference_workers": args.inference_workers,
+        "inference_backend": args.inference_backend,
+        "detection_decode_size": args.decode_size,
+        "detector_backend": args.detector_backend,
+        "recognizer_backend": args.recognizer_backend
+    }
+
+# Загрузка в сервис через detect (загрузка и ожидание результата). При переполнении очереди загрузка повторяется.
+async def detect_with_retry(service: DetectorService, file_name: str, data: bytes):
+    while True:
+        try:
+            return await service.detect(UploadFile(file=io.BytesIO(unique_payload(data)), filename=file_name))
+        except ServiceOverloadedException as ex:
+            await asyncio.sleep(ex.retry_after)
+
+async def run_service(args, images: list):
+    service = await DetectorService(args.detector, args.recognizer, **service_options(args)).initialize()
+    try:
+        for file_name, data in images[:args.warmup]:
+            await detect_with_retry(service, file_name, data)
+
+        semaphore = asyncio.Semaphore(max(1, args.concurrency))
+        async def timed_detect(file_name, data):
+            async with semaphore:
+                started_at = time.perf_counter()
+                result = await detect_with_retry(service, file_name, data)
+                return file_name, result, time.perf_counter() - started_at
+
+        started_at = time.perf_counter()
+        timed_results = await asyncio.gather(*[timed_detect(file_name, data) for file_name, data in images * args.repeat])
+        elapsed = time.perf_counter() - started_at
+    finally:
+        await service.cleanup()
+        # Фоновые задачи сервиса (обработка очереди, очистка) завершаем вместе с циклом событий.
+        for task in asyncio.all_tasks():
+            if task is not asyncio.current_task():
+                task.cancel()
+
+    result = report([latency for _, _, latency in timed_results], elapsed, len(timed_results))
+    values = {file_name: detect_result.get("values") for file_name, detect_result, _ in timed_results}
+    return result, values
+
+def bench_service(args, images: list):
+    return asyncio.run(run_service(args, images))
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def http_request(url: str, data: bytes = None, headers: dict = None):
+    request = urllib.request.Request(url, data=data, headers=headers or {}, method="POST" if data is not None else "GET")
+    while True:
+        try:
+            with urllib.request.urlopen(request, timeout=120) as response:
+                return json.loads(response.read())
+        except urllib.error.HTTPError as ex:
+            if ex.code != 503:
+                raise
+            time.sleep(float(ex.headers.get("Retry-After", "1")))
+
+def multipart_body(file_name: str, data: bytes):
+    boundary = uuid.uuid4().hex
+    body = (f"--{boundary}\r\n"
+            f"Content-Disposition: form-data; name=\"file\"; filename=\"{file_name}\"\r\n"
+            f"Content-Type: application/octet-stream\r\n\r\n").encode() + data + f"\r\n--{boundary}--\r\n".encode()
+    return body, {"Content-Type": f"multipart/form-data; boundary={boundary}"}
+
+# Загрузка через POST /upload/, ожидание обработки по GET /status/ и получение значений GET /values/.
+def http_upload_and_get_values(base_url: str, file_name: str, data: bytes, poll_interval: float):
+    body, headers = multipart_body(file_name, unique_payload(data))
+    image_uuid = http_request(f"{base_url}/upload/", body, headers)["uuid"]
+    while http_request(f"{base_url}/status/{image_uuid}")["status"] in ("queued", "processing"):
+        time.sleep(poll_interval)
+    return http_request(f"{base_url}/values/{image_uuid}")["values"]
+
+def bench_http(args, images: list):
+    import main
+    import uvicorn
+    # Сервис в том же процессе, с моделями и настройками бенчмарка.
+    main.DETECTOR_MODEL_PATH = args.detector
+    main.OCR_MODEL_PATH = args.recognizer
+    main.DETECTOR_BATCH_SIZE = args.service_batch_size
+    main.INFERENCE_WORKERS = args.inference_workers
+    main.INFERENCE_BACKEND = args.inference_backend
+    main.DETECTION_DECODE_SIZE = args.decode_size
+    main.DETECTOR_BACKEND = args.detector_backend
+    main.RECOGNIZER_BACKEND = args.recognizer_backend
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=port, log_level="warning"))
+    server_thread = threading.Thread(target=server.run, daemon=True)
+    server_thread.start()
+    while not server.started:
+        if not server_thread.is_alive():
+            raise RuntimeError("The HTTP server failed to start.")
+        time.sleep(0.05)
+
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        run = lambda item: (item[0], http_upload_and_get_values(base_url, item[0], item[1], args.poll_interval))
+        results, latencies, elapsed = run_load(run, images * args.repeat, args.warmup, args.concurrency)
+    finally:
+        server.should_exit = True
+        server_thread.join()
+    return report(latencies, elapsed, len(results)), dict(results)
+
+# Сравнение с базовым результатом: p95 задержки и изображений в секунду для каждого режима, распознанные значения.
+def compare_with_baseline(result: dict, baseline: dict, tolerance: float):
+    for key in COMPARED_CONFIG:
+        if baseline.get("config", {}).get(key) != result["config"][key]:
+            print(f"Warning: '{key}' differs from the baseline: {baseline.get('config', {}).get(key)} -> {result['config'][key]}")
+    regressions = []
+    for mode, mode_result in result["modes"].items():
+        baseline_mode = baseline.get("modes", {}).get(mode)
+        if baseline_mode is None:
+            continue
+        p95, baseline_p95 = mode_result["latency_ms"]["p95"], baseline_mode["latency_ms"]["p95"]
+        ips, baseline_ips = mode_result["images_per_second"], baseline_mode["images_per_second"]
+        print(f"{mode}: p95 {baseline_p95:.1f} -> {p95:.1f} ms ({p95 / baseline_p95 - 1:+.1%}), "
+              f"images/s {baseline_ips:.2f} -> {ips:.2f} ({ips / baseline_ips - 1:+.1%})")
+        if p95 > baseline_p95 * (1 + tolerance):
+            regressions.append(f"{mode}: p95 latency is {p95 / baseline_p95 - 1:.1%} higher than the baseline")
+        if ips < baseline_ips * (1 - tolerance):
+            regressions.append(f"{mode}: throughput is {1 - ips / baseline_ips:.1%} lower than the baseline")
+
+    for mode, mode_values in result["values"].items():
+        baseline_values = baseline.get("values", {}).get(mode, {})
+        for file_name, values in mode_values.items():
+            if file_name in baseline_values and baseline_values[file_name] != values:
+                regressions.append(f"{mode}: values of {file_name} changed: {baseline_values[file_name]} -> {values}")
+    return regressions
+
+# Выполняет режим бенчмарка. Возвращает результат режима и распознанные значения (None для detector и recognizer).
+def run_mode(args, mode: str, images: list):
+    if mode in ("detector", "recognizer", "pipeline"):
+        detector = ElectricMeterDetector(args.detector, backend=args.detector_backend).load()
+        recognizer = NumbersRecognizer(args.recognizer, backend=args.recognizer_backend).load()
+        pipeline = InferencePipeline(detector, recognizer, args.decode_size)
+    if mode == "detector":
+        return bench_detector(args, pipeline.detector, images), None
+    if mode == "recognizer":
+        return bench_recognizer(args, pipeline, images), None
+    if mode == "pipeline":
+        return bench_pipeline(args, pipeline, images)
+    if mode == "service":
+        return bench_service(args, images)
+    return bench_http(args, images)
+
+# Режим выполняется в новом процессе (spawn): пиковая память процесса (RSS) - память этого режима вместе с загрузкой моделей,
+# а не максимум по всем режимам, выполненным до него.
+def run_mode_in_process(args, mode: str, images: list):
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        return executor.submit(run_mode, args, mode, images).result()
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the detector, the recognizer, the pipeline and the service.")
+    parser.add_argument("--images", default="test_images", help="Directory with test images.")
+    parser.add_argument("--modes", default="detector,recognizer,pipeline",
+                        help=f"Comma separated modes to run: {', '.join(MODES)}.")
+    parser.add_argument("--detector", default=DETECTOR_MODEL_PATH)
+    parser.add_argument("--recognizer", default=OCR_MODEL_PATH)
+    parser.add_argument("--detector-backend", default="eager", choices=BACKENDS)
+    parser.add_argument("--recognizer-backend", default="eager", choices=BACKENDS)
+    parser.add_argument("--warmup", type=int, default=2, help="Number of warmup calls before measuring.")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of passes over the images.")
+    parser.add_argument("--concurrency", type=int, default=1, help="Number of concurrent calls (requests).")
+    parser.add_argument("--batch-size", type=int, default=1,
+                        help="Images per call in the detector, recognizer and pipeline modes.")
+    parser.add_argument("--service-batch-size", type=int, default=8, help="Detector batch size of the service.")
+    parser.add_argument("--decode-size", type=int, default=640, help="Reduced JPEG decode size for detection (0 - full size).")
+    parser.add_argument("--inference-workers", type=int, default=1, help="Inference workers of the service.")
+    parser.add_argument("--inference-backend", default="thread", choices=("thread", "process"),
+                        help="Inference backend of the service.")
+    parser.add_argument("--poll-interval", type=float, default=0.01, help="Status polling interval (s) in the http mode.")
+    parser.add_argument("--output", help="Path to save the result as JSON.")
+    parser.add_argument("--baseline", help="Path to a previously saved result to compare with.")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="Allowed relative p95 latency increase and throughput decrease compared to the baseline.")
+    args = parser.parse_args()
+
+    modes = [mode.strip() for mode in args.modes.split(",") if mode.strip()]
+    unknown_modes = [mode for mode in modes if mode not in MODES]
+    if unknown_modes:
+        print(f"Unknown modes: {', '.join(unknown_modes)}. Supported modes: {', '.join(MODES)}.")
+        return 1
+    images = load_images(args.images)
+    if len(images) == 0:
+        print(f"No images found in {args.images}.")
+        return 1
+
+    result = {
+        "config": {**vars(args), "images_count": len(images), "python": platform.python_version(),
+                   "torch": torch.__version__, "torch_threads": torch.get_num_threads(), "cpu_count": os.cpu_count()},
+        "modes": {},
+        "values": {}
+    }
+    for mode in modes:
+        mode_result, mode_values = run_mode_in_process(args, mode, images)
+        result["modes"][mode] = mode_result
+        if mode_values is not None:
+            result["values"][mode] = mode_values
+        latency = mode_result["latency_ms"]
+        print(f"{mode}: {mode_result['images']} images, {mode_result['images_per_second']:.2f} images/s, "
+              f"latency ms p50 {latency['p50']:.1f}, p95 {latency['p95']:.1f}, p99 {latency['p99']:.1f}, "
+              f"max {latency['max']:.1f}, peak RSS {mode_result['peak_rss_mb']:.0f} MB")
+        for stage, stage_latency in mode_result.get("stages_ms", {}).items():
+            print(f"  {stage}: p50 {stage_latency['p50']:.1f}, p95 {stage_latency['p95']:.1f}, "
+                  f"p99 {stage_latency['p99']:.1f} ms")
+
+    for mode, mode_values in result["values"].items():
+        print(f"{mode} values: {json.dumps(mode_values, ensure_ascii=False)}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+        print(f"Result saved to {args.output}.")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_with_baseline(result, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    sys.exit(main())
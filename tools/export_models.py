@@ -0,0 +1,81 @@
+# Экспорт моделей для бэкендов torchscript и onnx (см. models/backends.py).
+# Запуск из корня проекта:
+#   python -m tools.export_models --backends torchscript onnx --quantize
+import os
+import inspect
+import logging
+import argparse
+
+import torch
+from ultralytics import YOLO
+
+from models.recognizer import NumbersRecognizer
+from models.backends import artifact_path, quantize_dynamic
+
+DETECTOR_MODEL_PATH = './models/emeter_yolo11n_v1.pt'
+OCR_MODEL_PATH = './models/emeter_ocr_v1.pt'
+
+logger = logging.getLogger(__name__)
+
+def export_detector(model_path: str, backends: list):
+    model = YOLO(model_path)
+    for backend in backends:
+        if backend == "torchscript":
+            exported_path = model.export(format="torchscript")
+        elif backend == "onnx":
+            # Динамический размер батча, чтобы детектор мог обрабатывать батчи изображений.
+            exported_path = model.export(format="onnx", dynamic=True)
+        else:
+            continue
+        logger.info(f"Detector exported to {exported_path}.")
+
+def export_recognizer(model_path: str, backends: list, quantize: bool):
+    recognizer = NumbersRecognizer(model_path)
+    recognizer.device = "cpu"
+    model = recognizer.build_eager_model()
+    example = torch.zeros((1, recognizer.num_of_channels, 64, 384))
+
+    for backend in backends:
+        if backend == "torchscript":
+            variants = [(False, model)] + ([(True, quantize_dynamic(model))] if quantize else [])
+            for quantized, variant in variants:
+                output_path = artifact_path(model_path, backend, quantized)
+                with torch.no_grad():
+                    traced_model = torch.jit.trace(variant, example)
+                traced_model.save(output_path)
+                logger.info(f"Recognizer exported to {output_path}.")
+        elif backend == "onnx":
+            output_path = artifact_path(model_path, backend)
+            export_kwargs = {}
+            # Используем TorchScript экспортер, он поддерживает LSTM без дополнительных зависимостей.
+            if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+                export_kwargs["dynamo"] = False
+            torch.onnx.export(model, example, output_path,
+                              input_names=["image"], output_names=["logits", "lengths"],
+                              dynamic_axes={"image": {0: "batch"}, "logits": {1: "batch"}, "lengths": {0: "batch"}},
+                              **export_kwargs)
+            logger.info(f"Recognizer exported to {output_path}.")
+            if quantize:
+                from onnxruntime.quantization import QuantType, quantize_dynamic as onnx_quantize_dynamic
+                quantized_path = artifact_path(model_path, backend, quantized=True)
+                onnx_quantize_dynamic(output_path, quantized_path, weight_type=QuantType.QInt8)
+                logger.info(f"Recognizer exported to {quantized_path}.")
+
+def main():
+    parser = argparse.ArgumentParser(description="Export detector and recognizer models for the torchscript and onnx backends.")
+    parser.add_argument("--detector", default=DETECTOR_MODEL_PATH, help="Path to the YOLO model.")
+    parser.add_argument("--recognizer", default=OCR_MODEL_PATH, help="Path to the OCR model state dict.")
+    parser.add_argument("--backends", nargs="+", default=["torchscript", "onnx"], choices=["torchscript", "onnx"])
+    parser.add_argument("--quantize", action="store_true", help="Also export int8 dynamically quantized OCR models.")
+    parser.add_argument("--skip-detector", action="store_true")
+    parser.add_argument("--skip-recognizer", action="store_true")
+    args = parser.parse_args()
+
+    if not args.skip_detector:
+        export_detector(args.detector, args.backends)
+    if not args.skip_recognizer:
+        export_recognizer(args.recognizer, args.backends, args.quantize)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    main()
@@ -0,0 +1,116 @@
+# Проверка бэкенда (и способа декодирования CTC) перед включением:
+# сравнение результатов и скорости с eager моделями на тестовых изображениях.
+# Запуск из корня проекта:
+#   python -m tools.parity_check --detector-backend onnx --recognizer-backend torchscript --quantize
+import os
+import sys
+import time
+import logging
+import argparse
+
+from PIL import Image, ImageOps
+
+from models.backends import BACKENDS
+from common.decoder import CTCDecoder
+from models.recognizer import NumbersRecognizer
+from models.detector import ElectricMeterDetector
+from services.inference_pipeline import InferencePipeline
+
+DETECTOR_MODEL_PATH = './models/emeter_yolo11n_v1.pt'
+OCR_MODEL_PATH = './models/emeter_ocr_v1.pt'
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+
+def load_images(images_dir: str):
+    images = []
+    for file_name in sorted(os.listdir(images_dir)):
+        if file_name.lower().endswith(IMAGE_EXTENSIONS):
+            image = ImageOps.exif_transpose(Image.open(os.path.join(images_dir, file_name)))
+            image.load()
+            images.append((file_name, image))
+    return images
+
+def build_pipeline(detector_path, recognizer_path, detector_backend, recognizer_backend, quantize, decoder="flashlight"):
+    detector = ElectricMeterDetector(detector_path, backend=detector_backend).load()
+    recognizer = NumbersRecognizer(recognizer_path, backend=recognizer_backend, quantize=quantize,
+                                   decoder=decoder).load()
+    return InferencePipeline(detector, recognizer)
+
+# Обрабатывает изображения по одному, возвращает результаты и время обработки каждого изображения.
+def run_pipeline(pipeline: InferencePipeline, images: list, warmup: int):
+    for _, image in images[:warmup]:
+        pipeline.process_images([image])
+    results = []
+    timings = []
+    for _, image in images:
+        started_at = time.perf_counter()
+        results.append(pipeline.process_images([image])[0])
+        timings.append(time.perf_counter() - started_at)
+    return results, timings
+
+def compare(images: list, reference_results: list, candidate_results: list):
+    rows = []
+    for (file_name, _), reference_result, candidate_result in zip(images, reference_results, candidate_results):
+        ref_values, ref_detections = reference_result["values"], reference_result["detections"]
+        values, detections = candidate_result["values"], candidate_result["detections"]
+        ref_confidences = sorted(d["confidence"] for d in ref_detections)
+        confidences = sorted(d["confidence"] for d in detections)
+        confidence_delta = max([abs(a - b) for a, b in zip(ref_confidences, confidences)], default=0.0)
+        rows.append({
+            "image": file_name,
+            "values_match": ref_values == values,
+            "detections_match": len(ref_detections) == len(detections),
+            "confidence_delta": confidence_delta,
+            "reference_values": ref_values,
+            "values": values
+        })
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare a detector/recognizer backend with the eager models.")
+    parser.add_argument("--images", default="test_images", help="Directory with test images.")
+    parser.add_argument("--detector", default=DETECTOR_MODEL_PATH)
+    parser.add_argument("--recognizer", default=OCR_MODEL_PATH)
+    parser.add_argument("--detector-backend", default="eager", choices=BACKENDS)
+    parser.add_argument("--recognizer-backend", default="eager", choices=BACKENDS)
+    parser.add_argument("--quantize", action="store_true", help="Use the int8 dynamically quantized OCR model.")
+    parser.add_argument("--decoder", default="flashlight", choices=CTCDecoder.METHODS, help="CTC decoding method.")
+    parser.add_argument("--warmup", type=int, default=2, help="Number of warmup images for each pipeline.")
+    parser.add_argument("--min-agreement", type=float, default=1.0,
+                        help="Minimum share of images with the same values as the eager models.")
+    args = parser.parse_args()
+
+    images = load_images(args.images)
+    if len(images) == 0:
+        print(f"No images found in {args.images}.")
+        return 1
+
+    reference = build_pipeline(args.detector, args.recognizer, "eager", "eager", False)
+    reference_results, reference_timings = run_pipeline(reference, images, args.warmup)
+    candidate = build_pipeline(args.detector, args.recognizer, args.detector_backend, args.recognizer_backend,
+                               args.quantize, args.decoder)
+    candidate_results, candidate_timings = run_pipeline(candidate, images, args.warmup)
+
+    rows = compare(images, reference_results, candidate_results)
+    for row in rows:
+        if not row["values_match"] or not row["detections_match"]:
+            print(f"{row['image']}: eager {row['reference_values']}, candidate {row['values']}, "
+                  f"max confidence delta {row['confidence_delta']:.4f}")
+
+    agreement = sum(row["values_match"] for row in rows) / len(rows)
+    detections_agreement = sum(row["detections_match"] for row in rows) / len(rows)
+    max_confidence_delta = max(row["confidence_delta"] for row in rows)
+    speedup = sum(reference_timings) / sum(candidate_timings)
+    print(f"Backend: detector '{args.detector_backend}', recognizer '{args.recognizer_backend}'"
+          f"{' (int8)' if args.quantize else ''}, decoder '{args.decoder}', images: {len(rows)}")
+    print(f"Values agreement with eager: {agreement:.2%} (delta {agreement - 1:.2%})")
+    print(f"Detections count agreement with eager: {detections_agreement:.2%}, max confidence delta: {max_confidence_delta:.4f}")
+    print(f"Mean time per image: eager {sum(reference_timings) / len(rows):.4f} s, "
+          f"candidate {sum(candidate_timings) / len(rows):.4f} s, speedup x{speedup:.2f}")
+    if agreement < args.min_agreement:
+        print(f"Agreement is lower than {args.min_agreement:.2%}, the backend should not be enabled.")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    sys.exit(main())